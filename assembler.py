@@ -1,144 +1,298 @@
-from vm import REQS, PUSH
+from vm import REQS, PUSH, JUMP, JZ, RETURN, HALT, YIELD, POP, DUP, FLIP, ADD, SUB, NOT, MUL, DIV, MOD, READ, SHA256, ECVERIFY, MEMCMP, MEMHASH, STACKLEN, MEMORYLEN, AREALEN, KEYHAS, AREA, WMAX, WMASK
 import sys
 
 opcodes = [req[0].lower() for req in REQS]
 #print(opcodes)
 
-def optimize(text):
-	optimized = []
-	last = None
-	lastpushed = None
-	skip = False
-	for i, line in enumerate(text):
+# Decoded instructions are [opcode, argument] lists, labels are [LABEL, name]
+LABEL = None
 
-		if skip:
-			skip = False
-			continue
+def intorlabel(arg):
+	try:
+		return int(arg)
+	except:
+		return arg
 
-		nextline = text[i+1] if i + 1 < len(text) else None
-		if line[:4] == "PUSH":
-			if line == "PUSH 0" and nextline in ["ADD", "SUB"]:
-				#Can only do these if there is something one the stack. Otherwise different behavior (no failure)
-				skip = True
-				continue
-			elif line == "PUSH 1" and nextline in ["MUL", "DIV"]:
-				skip = True
-				continue
-			elif line == lastpushed:
-				optimized.append("DUP")
-			else:
-				lastpushed = line
-				optimized.append(line)
-		elif nextline == "NOT" and line == "NOT":
-			skip = True
-			continue
-		else:
-			lastpushed = None
-			optimized.append(line)
-		last = line
-	return optimized    
-
-def assemble(text):
-	#print("Assembling...")
+def decode(text):
+	"""Decodes assembly (text or a list of lines) into instructions. Arguments
+	are ints or label names, "JZ label" and "JUMP label" become a PUSH of the
+	label followed by the jump"""
 	if isinstance(text, str):
 		text = text.split("\n")
-	text_unopt = "\n".join(text)
-	text_opt = text
-	#for i in range(5):
-	#    text_opt = optimize(text_opt)
-	text_opt = "\n".join(text_opt)
-	#print(text_opt)
-	asm = translate(text_opt)
-	#print("Optimized:", len(asm), "Unoptimized:", len(translate(text_unopt)))
-	return asm
-
-def translate(text):
-	lines = text.split("\n")
-
-	labels = {}
-	opcounter = 0
-
-	def intorlabel(arg):
-		try:
-			return int(arg)
-		except:
-			return arg
-
-	lines = [{"source":line} for line in lines]
-	for line in lines:
-		clean = line["source"].strip().lower()
+	instructions = []
+	for line in text:
+		clean = line.strip().lower()
 		if ";" in clean:
 			clean = clean[:clean.find(";")]
-
-		line["clean"] = clean
-
 		opline = clean.split(" ")
-		line["opline"] = opline
 
 		if len(opline) == 1 and opline[0].endswith(":"):
-			label = opline[0][:-1]
-			line["name"] = label
-			labels[label] = {"opc":opcounter}
-			ignore = True
-			line["type"] = "label"
+			instructions.append([LABEL, opline[0][:-1]])
 		elif opline[0] in opcodes:#meh
-			opcounter += 1
-			ignore = False
-			line["type"] = "code"
+			op = opcodes.index(opline[0])
+			if op == PUSH:
+				instructions.append([PUSH, intorlabel(opline[1])])
+			elif op in [JZ, JUMP] and len(opline) > 1:
+				instructions.append([PUSH, intorlabel(opline[1])])
+				instructions.append([op, None])
+			else:
+				instructions.append([op, None])
 		elif opline[0]:
 			raise Exception("Invalid symbol:", opline[0])
+	return instructions
+
+def emit(instructions):
+	"""Lays out instructions and replaces label names with their code offsets"""
+	labels = {}
+	offset = 0
+	for op, arg in instructions:
+		if op is LABEL:
+			labels[arg] = offset
 		else:
-			line["type"] = "whitespace"
-			ignore = True
-		line["ignore"] = ignore
-		line["opcount"] = opcounter
+			offset += REQS[op][1]
+	code = []
+	for op, arg in instructions:
+		if op is LABEL:
+			continue
+		code.append(op)
+		if REQS[op][1] > 1:
+			code.append(labels.get(arg, arg))
+	return code
+
+# What the peephole optimizer knows about a stack value: ints are constants
+ANY, INT, WORD = "any", "int", "word"
+# Stack values tracked below the top
+DEPTH = 8
+
+def isint(kind):
+	return kind in [INT, WORD] or type(kind) is int
+
+def isword(kind):
+	return kind == WORD or (type(kind) is int and 0 <= kind < WMAX)
+
+def effect(known, op, arg):
+	"""The kinds of the values on top of the stack after op, given the ones
+	before. Values below the known ones may be anything, an empty list means
+	nothing is known. Instructions that raise (like ADD on None) never reach
+	the next one, so their results are assumed to be well formed"""
+	if op == PUSH:
+		return (known + [arg if type(arg) is int else WORD])[-DEPTH:]
+	if op == DUP:
+		return (known + [known[-1] if known else ANY])[-DEPTH:]
+	if op in [STACKLEN, MEMORYLEN]:
+		return (known + [WORD])[-DEPTH:]
+	if op in [AREA]:
+		return known
+	if op == POP:
+		return known[:-1]
+	if op == FLIP:
+		if len(known) < 2:
+			return []
+		return known[:-2] + [known[-1], known[-2]]
+	if op in [NOT, SHA256, AREALEN, KEYHAS]:
+		return known[:-1] + [WORD]
+	if op in [SUB, MUL]:
+		return known[:-2] + [WORD]
+	if op in [ADD, DIV, MOD]:
+		return known[:-2] + [INT]
+	if op == READ:
+		return known[:-2] + [ANY]
+	if op in [ECVERIFY, MEMCMP, MEMHASH]:
+		return known[:-REQS[op][2]] + [WORD]
+	if op in [HALT, YIELD, RETURN, JUMP, LABEL] or REQS[op][3] > 0:
+		# Others may change the stack while the process is paused
+		return []
+	if REQS[op][3] < 0:
+		return known[:REQS[op][3]]
+	return []
 
-		if line["ignore"]:
+def fold(op, a, b=None):
+	"""Computes op on constants like the VM, None if it would fail"""
+	if op == ADD:
+		return a + b
+	if op == SUB:
+		return (a - b) % WMAX
+	if op == MUL:
+		return (a * b) % WMAX
+	if op == DIV and b != 0:
+		return a // b
+	if op == MOD and b != 0:
+		return a % b
+	if op == NOT:
+		return ~a & WMASK
+	return None
+
+def ispush(instr, value=None):
+	"""Whether instr pushes a constant (value, if given)"""
+	return instr[0] == PUSH and type(instr[1]) is int and (value is None or instr[1] == value)
+
+def rewrite(instructions, size=False):
+	"""One left to right peephole pass: constant folding of arithmetic and
+	branches, operations that do not change a value, PUSH or DUP followed by
+	POP and, if size, PUSH x PUSH x to PUSH x DUP (shorter but costs more gas)"""
+	out = []
+	# known[i] is what is known about the stack after out[i]
+	known = []
+	todo = list(reversed(instructions))
+	while todo:
+		instr = todo.pop()
+		op, arg = instr
+		before = known[-1] if known else []
+		under = known[-2] if len(known) > 1 else []
+		if op is LABEL:
+			out.append(instr)
+			known.append([])
 			continue
-		op = line["opline"][0]
-		if op == "push":
-			line["code"] = [PUSH, intorlabel(line["opline"][1])]
-		elif op in opcodes:
-			line["code"] = [opcodes.index(op)]
-		else:
-			raise Exception("Unknown opcode %s" % line)
 
-	# Calculate label offsets from expanded code
-	offset = 0
-	for line in lines:
-		line["offset"] = offset
-		if line["type"] == "label":
-			labels[line["name"]] = offset
-		elif line["type"] == "code":
-			offset += len(line["code"])
-
-	# Extend jumps with offset pushes
-	for line in lines:
-		if line["type"] == "code" and line["opline"][0] in ["jz", "jump"] and not isinstance(line["opline"][1], int):
-			line["code"] = [PUSH, labels[line["opline"][1]]] + line["code"]
-
-	# Lastly, replace all labels with offsets
-	total = []
-	for line in lines:
-		if line["type"] == "code":
-			line["code"] = [labels[exp] if exp in labels else exp for exp in line["code"]]
-			total += line["code"]
-	print(lines)
-	"""
-	for i, line in enumerate(lines):
-		if line["type"] == "code":
-			print("%i\t%i\t%s\t%s" % (line["opcount"], line["offset"], " ".join(map(str, line["code"])), "\t".join(line["opline"])))
-		elif line["type"] == "label":
-			print("%i\t%i\t%s" % (line["opcount"], line["offset"], line["name"]))
-
-	#print("".join(map(lambda x:hex(x)[2:].zfill(16), total)))
-	print(total)
-	"""
-	return total
-#bfile = open("bytecode.js", "w+")
-#bfile.write("var code = "+str(code))
-#bfile.close()
+		last = out[-1] if out else [LABEL, None]
+		second = out[-2] if len(out) > 1 else [LABEL, None]
+		replacement = None
+		if op in [ADD, SUB, MUL, DIV, MOD] and ispush(second) and ispush(last):
+			value = fold(op, second[1], last[1])
+			if value is not None:
+				replacement = [[PUSH, value]]
+				del out[-2:], known[-2:]
+		elif op == NOT and ispush(last):
+			replacement = [[PUSH, fold(NOT, last[1])]]
+			del out[-1:], known[-1:]
+		elif ((op == ADD and ispush(last, 0) and under and isint(under[-1])) or
+				(op in [SUB] and ispush(last, 0) and under and isword(under[-1])) or
+				(op == MUL and ispush(last, 1) and under and isword(under[-1])) or
+				(op == DIV and ispush(last, 1) and under and isint(under[-1])) or
+				(op == NOT and last[0] == NOT and under and isword(under[-1]))):
+			replacement = []
+			del out[-1:], known[-1:]
+		elif op == POP and (last[0] == PUSH or last[0] == DUP):
+			replacement = []
+			del out[-1:], known[-1:]
+		elif op == JZ and ispush(second) and last[0] == PUSH:
+			target = last[1]
+			replacement = [[PUSH, target], [JUMP, None]] if second[1] == 0 else []
+			del out[-2:], known[-2:]
+		elif size and ispush(instr) and ispush(last, arg):
+			replacement = [[DUP, None]]
+
+		if replacement is not None:
+			todo.extend(reversed(replacement))
+			continue
+		out.append(instr)
+		known.append(effect(before, op, arg))
+	return out
+
+def targets(instructions):
+	"""Names of the labels pushed anywhere"""
+	return set(arg for op, arg in instructions if op == PUSH and type(arg) is not int)
+
+def eliminate(instructions):
+	"""Removes labels nothing jumps to and code after JUMP or RETURN that no
+	label leads to"""
+	used = targets(instructions)
+	out = []
+	dead = False
+	for op, arg in instructions:
+		if op is LABEL:
+			if arg not in used:
+				continue
+			dead = False
+		if not dead:
+			out.append([op, arg])
+		if op in [JUMP, RETURN]:
+			dead = True
+	return out
+
+def thread(instructions):
+	"""Jumps to a jump go to its target directly, jumps to the next
+	instruction are removed"""
+	labels = {arg: i for i, (op, arg) in enumerate(instructions) if op is LABEL}
+
+	def following(i):
+		"""Index of the first instruction at or after i that is not a label"""
+		while i < len(instructions) and instructions[i][0] is LABEL:
+			i += 1
+		return i
+
+	def final(label):
+		seen = set()
+		while label in labels and label not in seen:
+			seen.add(label)
+			i = following(labels[label])
+			if i + 1 < len(instructions) and instructions[i][0] == PUSH and instructions[i][1] not in seen and instructions[i+1][0] == JUMP:
+				label = instructions[i][1]
+			else:
+				break
+		return label
+
+	out = []
+	skip = 0
+	for i, (op, arg) in enumerate(instructions):
+		if skip:
+			skip -= 1
+			continue
+		if op == PUSH and type(arg) is not int and i + 1 < len(instructions) and instructions[i+1][0] in [JUMP, JZ]:
+			arg = final(arg)
+			if instructions[i+1][0] == JUMP:
+				# Falls through to the target anyway
+				j = i + 2
+				while j < len(instructions) and instructions[j][0] is LABEL and instructions[j][1] != arg:
+					j += 1
+				if j < len(instructions) and instructions[j] == [LABEL, arg]:
+					skip = 1
+					continue
+		out.append([op, arg])
+	return out
+
+def relocatable(instructions):
+	"""Whether every jump target is a pushed label and every label is defined
+	once, so code can be moved"""
+	labels = [arg for op, arg in instructions if op is LABEL]
+	if len(set(labels)) != len(labels) or not targets(instructions) <= set(labels):
+		return False
+	for i, (op, arg) in enumerate(instructions):
+		if op in [JUMP, JZ]:
+			if i == 0 or instructions[i-1][0] != PUSH or type(instructions[i-1][1]) is int:
+				return False
+	return True
+
+def peephole(instructions, size=False, passes=10):
+	"""Optimizes decoded instructions until nothing changes. Programs that
+	jump to computed offsets are returned as they are. The result behaves
+	like the input except for gas and mem, assuming nothing else changes the
+	process while it runs"""
+	if not relocatable(instructions):
+		return instructions
+	for i in range(passes):
+		optimized = thread(eliminate(rewrite(instructions, size)))
+		if optimized == instructions:
+			break
+		instructions = optimized
+	return instructions
+
+def assemble(text, optimize=True, registers=False):
+	"""Assembles text or a list of lines, with the peephole optimizer if
+	optimize. registers keeps loop variables on the stack (see regalloc.py)"""
+	instructions = decode(text)
+	if registers:
+		from regalloc import allocate
+		instructions = allocate(instructions)
+	if optimize:
+		instructions = peephole(instructions)
+	return emit(instructions)
+
+def translate(text):
+	"""Assembles text without optimizing it"""
+	return emit(decode(text))
+
 import struct
+from words import Words
+
+def writebinary(path, state):
+	"""Writes a flat state (list or Words) as big-endian signed 64 bit words, prefixed by its length"""
+	if not isinstance(state, Words):
+		state = Words(state)
+	with open(path, "wb") as f:
+		f.write(struct.pack(">q", len(state)))
+		f.write(state.tobytes(8, signed=True))
+
 if __name__ == "__main__":
 	if len(sys.argv) < 2:
 		print("need input file")
@@ -150,12 +304,10 @@ if __name__ == "__main__":
 		text = f.read()
 
 	code = assemble(text)
-	binary = [0,0,1000,1000,0,len(code),0,0,0] + code
-	print(binary)
+	binary = Words([0,0,1000,1000,0,len(code),0,0,0] + code)
+	print(binary.tolist())
 	if len(sys.argv) > 2:
 		print("Writing to %s" % sys.argv[2])
-		with open(sys.argv[2], "wb") as f:
-			f.write(struct.pack(">q", len(binary)))
-			f.write(struct.pack(">%uq" % len(binary), *binary))
+		writebinary(sys.argv[2], binary)
 	else:
 		print("No output file given")
@@ -0,0 +1,141 @@
+"""Compiles and runs many programs in a process pool and summarizes the results.
+
+Usage: python batch.py [options] [<file or directory>...]   (default: et/)
+
+    --gas <n>, --mem <n>     budget of every run (default 10000 and 1000000)
+    --steps <n>              stops runs after n steps (default 1000000), a
+                             negative GAS never runs out
+    --jobs <n>               worker processes (default: one per CPU)
+    --lalr                   compiles with the LALR parser
+    --registers              keeps loop variables on the stack (see regalloc.py)
+    --compile-cache <dir>    loads unchanged programs instead of compiling them
+    --json <file>, --csv <file>   writes the summary, - for stdout
+
+Every worker builds the parser once, then compiles its files and runs them
+like vm.run (with vm.resume, which counts the steps). A line per file (status from STATI, gas and mem used, steps, compile
+and run time in seconds) goes to stdout unless the summary does."""
+
+import io
+import os
+import sys
+import csv
+import json
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from vm import load, resume, dump, STATUS, STATI, NORMAL, GAS, MEM
+from difftest import paths
+
+FIELDS = ["file", "status", "gas", "mem", "steps", "compile", "run", "error"]
+
+# Compiler options of the worker, set by setup
+OPTIONS = {}
+
+def setup(algorithm="earley", registers=False, cache=None):
+    """Initializes a worker: builds the parser and opens the compile cache"""
+    OPTIONS.update(algorithm=algorithm, registers=registers, cache=None)
+    if cache is not None:
+        from compilecache import CompileCache
+        OPTIONS["cache"] = CompileCache(cache)
+    from parser import getparser
+    getparser(algorithm)
+
+def compilefile(path):
+    """The flat state for a .et or .as file, compiled with the worker's options"""
+    with open(path) as f:
+        text = f.read()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if path.endswith(".as"):
+            from assembler import assemble
+            code = assemble(text, registers=OPTIONS["registers"])
+            return [0,0,0,0,0,len(code),0,0,0] + code
+        from parser import parse
+        return parse(text, **OPTIONS)
+
+def job(path, gas, mem, steps):
+    """Compiles and runs one file, returns its summary as a dict"""
+    result = dict.fromkeys(FIELDS)
+    result["file"] = path
+    start = time.perf_counter()
+    try:
+        state = compilefile(path)
+    except Exception as e:
+        result["status"] = "COMPILEERROR"
+        result["error"] = "%s: %s" % (type(e).__name__, str(e).split("\n")[0])
+        return result
+    result["compile"] = round(time.perf_counter() - start, 6)
+
+    start = time.perf_counter()
+    state[STATUS] = NORMAL
+    state[GAS] = gas
+    state[MEM] = mem
+    try:
+        states = load(state)
+        result["steps"] = resume(states, limit=steps)
+        final = dump(states)
+    except Exception as e:
+        result["status"] = "ERROR"
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        return result
+    result["run"] = round(time.perf_counter() - start, 6)
+    result["status"] = STATI[final[STATUS]]
+    result["gas"] = gas - final[GAS]
+    result["mem"] = mem - final[MEM]
+    return result
+
+def batch(files, gas=10000, mem=1000000, steps=1000000, jobs=None, algorithm="earley", registers=False, cache=None):
+    """Summaries of compiling and running every file, in order"""
+    jobs = jobs or os.cpu_count() or 1
+    # A few chunks per worker, so small files do not wait on each other's messages
+    chunksize = max(1, len(files) // (4 * jobs))
+    with ProcessPoolExecutor(jobs, initializer=setup, initargs=(algorithm, registers, cache)) as pool:
+        return list(pool.map(job, files, [gas] * len(files), [mem] * len(files), [steps] * len(files), chunksize=chunksize))
+
+def write(path, results, kind):
+    f = sys.stdout if path == "-" else open(path, "w", newline="")
+    if kind == "json":
+        json.dump(results, f, indent=1)
+        f.write("\n")
+    else:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    if f is not sys.stdout:
+        f.close()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    def option(name, default=None, flag=False):
+        if name not in args:
+            return default
+        i = args.index(name)
+        if flag:
+            del args[i]
+            return True
+        value = args[i+1]
+        del args[i:i+2]
+        return value
+
+    gas = int(option("--gas", 10000))
+    mem = int(option("--mem", 1000000))
+    steps = int(option("--steps", 1000000))
+    jobs = option("--jobs")
+    algorithm = "lalr" if option("--lalr", flag=True) else "earley"
+    registers = option("--registers", False, flag=True)
+    cache = option("--compile-cache")
+    outputs = [(option("--json"), "json"), (option("--csv"), "csv")]
+
+    files = list(paths(args or ["et"]))
+    start = time.perf_counter()
+    results = batch(files, gas, mem, steps, jobs and int(jobs), algorithm, registers, cache)
+    wall = time.perf_counter() - start
+
+    for path, kind in outputs:
+        if path is not None:
+            write(path, results, kind)
+    if "-" not in [path for path, kind in outputs]:
+        print("file\tstatus\tgas\tmem\tsteps\tcompile\trun")
+        for result in results:
+            print("\t".join("" if result[field] is None else str(result[field]) for field in FIELDS[:-1]))
+        print("%i files in %.2fs" % (len(results), wall))
@@ -0,0 +1,66 @@
+"""Compile latency per file, with the parser built on every call (as before
+parser.getparser) and with the cached Earley and LALR parsers.
+
+Usage: python benchparse.py [<file or directory>...]   (default: et/)"""
+
+import os
+import io
+import sys
+import time
+import tempfile
+import contextlib
+
+from lark.lark import Lark
+
+import parser
+from difftest import paths
+
+def compiles(path, algorithm):
+    """Compiles path once, returns the seconds it took or None if it does not compile"""
+    with open(path) as f:
+        text = f.read()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            parser.parse(text, algorithm=algorithm)
+    except Exception:
+        return None
+    return time.perf_counter() - start
+
+def rebuilt(path):
+    """Compiles path with a freshly built parser, like parse did on every call"""
+    parser.PARSERS.pop("earley", None)
+    return compiles(path, "earley")
+
+def timeit(f, repeat=5):
+    times = [f() for i in range(repeat)]
+    if None in times:
+        return None
+    return min(times)
+
+def ms(t):
+    return "-" if t is None else "%.1f" % (t * 1000)
+
+if __name__ == "__main__":
+    files = [path for path in paths(sys.argv[1:] or ["et"]) if path.endswith(".et")]
+    cache = os.path.join(tempfile.mkdtemp(), "lalr.cache")
+
+    start = time.perf_counter()
+    Lark(parser.grammar, debug=True)
+    print("build earley\t%s ms" % ms(time.perf_counter() - start))
+    start = time.perf_counter()
+    parser.getparser("lalr", cache)
+    print("build lalr\t%s ms" % ms(time.perf_counter() - start))
+    parser.PARSERS.pop("lalr")
+    start = time.perf_counter()
+    parser.getparser("lalr", cache)
+    print("load lalr cache\t%s ms" % ms(time.perf_counter() - start))
+
+    print("file\trebuilt\tearley\tlalr\t(ms per compile)")
+    totals = [0, 0, 0]
+    for path in files:
+        times = [timeit(lambda: rebuilt(path)), timeit(lambda: compiles(path, "earley")), timeit(lambda: compiles(path, "lalr"))]
+        print("%s\t%s" % (path, "\t".join(map(ms, times))))
+        if None not in times:
+            totals = [total + t for total, t in zip(totals, times)]
+    print("total\t%s" % "\t".join(map(ms, totals)))
@@ -0,0 +1,93 @@
+"""Microbenchmarks for stack, memory area and hash heavy workloads.
+
+Usage: python benchvm.py [<workload>...] [--steps n]   (default: all, 200000 steps)
+
+Every workload is a loop of assembly that runs until the step limit. Prints
+steps per second of both engines, the reference interpreter (execute) and
+dispatch, on a stack or area that is already `size` words long."""
+
+import sys
+import time
+
+from vm import load, execute, dispatch, s, STATUS, NORMAL, RECURSE
+from assembler import translate
+from crypto import hashint
+
+WORKLOADS = {
+    # Pushes and pops on top of a deep stack
+    "pushpop": """
+start:
+	push 1
+	push 2
+	push 3
+	pop
+	pop
+	pop
+	push start
+	jump
+""",
+    # Binary instructions take their operands from a deep stack
+    "arith": """
+start:
+	push 1
+	push 2
+	add
+	push 3
+	mul
+	pop
+	push start
+	jump
+""",
+    # Grows an area and shrinks it again
+    "allocdealloc": """
+start:
+	push 1
+	push 16
+	alloc
+	push 1
+	push 16
+	dealloc
+	push start
+	jump
+""",
+    # Hashes a few values over and over, like a hash chain (see crypto.hashint)
+    "sha256": """
+start:
+	push 1
+	sha256
+	sha256
+	sha256
+	pop
+	push start
+	jump
+""",
+}
+
+def state(text, size):
+    """Sharp state running text, with `size` words on the stack and in area 1"""
+    code = translate(text)
+    return [NORMAL, 0, -1, 10**15, 0, code, [0] * size, [], [[], [0] * size]]
+
+def bench(text, size, engine, steps):
+    """Steps per second of an engine on a workload"""
+    states = load(s(state(text, size)))
+    start = time.perf_counter()
+    count = engine(states, steps)
+    elapsed = time.perf_counter() - start
+    assert states[0][0][STATUS] in [NORMAL, RECURSE], "workload stopped"
+    return count / elapsed
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    steps = 200000
+    if "--steps" in args:
+        i = args.index("--steps")
+        steps = int(args[i+1])
+        del args[i:i+2]
+    print("workload\tsize\texecute/s\tdispatch/s")
+    for name in args or WORKLOADS:
+        for size in [10, 10000]:
+            rates = [bench(WORKLOADS[name], size, engine, steps) for engine in (execute, dispatch)]
+            print("%s\t%i\t%.0f\t%.0f" % (name, size, rates[0], rates[1]))
+    info = hashint.cache_info()
+    print("sha256 cache: %i hits, %i misses" % (info.hits, info.misses))
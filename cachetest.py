@@ -0,0 +1,58 @@
+"""Checks the compile cache keys of function bodies (see parser.fingerprint).
+
+Usage: python cachetest.py [bodies]
+
+Compiles `bodies` different function bodies. Every body must get its own key,
+and a second process must get the same keys for the same bodies."""
+
+import io
+import sys
+import hashlib
+import tempfile
+import contextlib
+import subprocess
+
+from parser import parse
+from compilecache import CompileCache
+
+BODY = "def f():\n    a = %i + $arealen(0)\n"
+
+class Recorder(CompileCache):
+    """A compile cache that remembers the function body fingerprints it is asked for"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.fingerprints = []
+
+    def compile(self, kind, source, build):
+        if kind.endswith("function"):
+            self.fingerprints.append(source)
+        return super().compile(kind, source, build)
+
+def fingerprints(bodies):
+    with tempfile.TemporaryDirectory() as path:
+        cache = Recorder(path)
+        for i in range(bodies):
+            # The compiler is chatty, and only the function body has to compile
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    parse(BODY % i, cache=cache)
+                except Exception:
+                    pass
+    assert len(cache.fingerprints) == bodies, "%i bodies, %i fingerprints" % (bodies, len(cache.fingerprints))
+    return cache.fingerprints
+
+def digest(keys):
+    return hashlib.sha256(b"\0".join(keys)).hexdigest()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "--digest":
+        print(digest(fingerprints(int(args[1]))))
+        sys.exit()
+    bodies = int(args[0]) if args else 39
+    keys = fingerprints(bodies)
+    assert len(set(keys)) == bodies, "%i bodies, %i different keys" % (bodies, len(set(keys)))
+    other = subprocess.run([sys.executable, __file__, "--digest", str(bodies)], capture_output=True, text=True, check=True).stdout.strip()
+    assert other == digest(keys), "another process gets other keys"
+    print("ok\t%i bodies, %i different keys, same in another process" % (bodies, len(set(keys))))
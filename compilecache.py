@@ -0,0 +1,74 @@
+"""On-disk cache of compiled flat states.
+
+Programs are keyed by the SHA256 of their source text, function bodies by a
+fingerprint of their nodes and the macros they expand (see
+parser.fingerprint). Every key includes the compiler version, a hash of the
+compiler's own sources, so changing the compiler invalidates the cache.
+
+    cache = CompileCache(".etcache")
+    state = parse(code, cache=cache)
+    print(cache.stats())
+"""
+
+import os
+import json
+import hashlib
+
+# Modules whose code decides what a program compiles to
+SOURCES = ["parser.py", "assembler.py", "regalloc.py", "vm.py"]
+
+def compilerversion():
+    h = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class CompileCache:
+    """Compiled flat states in a directory, one JSON file per key"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.version = compilerversion()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind, source):
+        """Key of a "program" or "function" compiled from source (str or bytes)"""
+        if isinstance(source, str):
+            source = source.encode("utf8")
+        h = hashlib.sha256()
+        h.update(("%s\n%s\n" % (self.version, kind)).encode())
+        h.update(source)
+        return h.hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key + ".json")) as f:
+                flat = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return flat
+
+    def put(self, key, flat):
+        path = os.path.join(self.path, key + ".json")
+        temp = "%s.%i.tmp" % (path, os.getpid())
+        with open(temp, "w") as f:
+            json.dump(list(flat), f)
+        os.replace(temp, path)
+
+    def compile(self, kind, source, build):
+        """The cached flat state for source, or build() and cache it"""
+        key = self.key(kind, source)
+        flat = self.get(key)
+        if flat is None:
+            flat = build()
+            self.put(key, flat)
+        return flat
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "compile cache %s: %i hits, %i misses (%.0f%% hit rate)" % (self.path, self.hits, self.misses, 100 * self.hits / total if total else 0)
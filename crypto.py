@@ -1,6 +1,12 @@
 from ecdsa import SigningKey, VerifyingKey, NIST256p
+from ecdsa.ellipticcurve import PointJacobi
 from hashlib import sha3_256
+from functools import lru_cache
+from collections import OrderedDict
 from vm import BYTESIZE
+
+# Most recent results hashint keeps, hashint.cache_info() counts hits and misses
+HASHCACHE = 4096
 """
 sk = SigningKey.generate(curve=NIST256p) # uses NIST192p
 vk = sk.get_verifying_key()
@@ -13,9 +19,19 @@ def hashit(byte):
     hsh = sha3_256(byte)
     return hsh.digest()
 
+def hashwords(words):
+    """Hash of a range of memory words, as one int like wrapint"""
+    return fromb(hashit(b"".join(tob(word) for word in words)))
+
 def wrapint(number, func):
     return fromb(func(tob(number)))
 
+@lru_cache(maxsize=HASHCACHE)
+def hashint(number):
+    """wrapint(number, hashit), remembers recent results because hash
+    chains hash the same values again"""
+    return fromb(hashit(tob(number)))
+
 def tob(number):
     return number.to_bytes(BYTESIZE, byteorder="big", signed=False)
 
@@ -27,10 +43,72 @@ def genkey():
     vk = sk.get_verifying_key()
     return sk.to_string(), vk.to_string()
 
+def parsekey(key, precompute=False):
+    """The VerifyingKey of a public key as bytes, None if it is not one. With
+    precompute, its multiplication table is computed first, which takes as
+    long as two verifications and makes the following ones twice as fast"""
+    try:
+        vk = VerifyingKey.from_string(key, curve=NIST256p)
+    except Exception:
+        return None
+    if precompute:
+        # from_string leaves out the order of the point, which the table needs
+        point = vk.pubkey.point
+        point = PointJacobi(point.curve(), point.x(), point.y(), 1, NIST256p.order, generator=True)
+        vk = VerifyingKey.from_public_point(point, curve=NIST256p, validate_point=False)
+    return vk
+
+class KeyCache:
+    """Parsed public keys, the least recently used are dropped first. A key
+    is precomputed (see parsekey) when it is verified the `precompute`th time"""
+
+    def __init__(self, size=256, precompute=2):
+        self.keys = OrderedDict()
+        self.size = size
+        self.precompute = precompute
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The VerifyingKey of a public key as bytes, None if it is not one"""
+        entry = self.keys.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self.keys[key] = [parsekey(key), 0]
+            if len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+        else:
+            self.hits += 1
+            self.keys.move_to_end(key)
+        entry[1] += 1
+        if entry[1] == self.precompute and entry[0] is not None:
+            entry[0] = parsekey(key, precompute=True)
+        return entry[0]
+
+KEYS = KeyCache()
+
 def verify(key, signature, message):
-    vk = VerifyingKey.from_string(key, curve=NIST256p)
+    vk = KEYS.get(bytes(key))
+    if vk is None:
+        return False
     try:
         vk.verify(signature, message, hashfunc=sha3_256)
         return True
     except:
         return False
+
+def verifywords(key, signature, message):
+    """verify() on memory words (see ECVERIFY), False if one does not fit in a word"""
+    try:
+        key, signature, message = [b"".join(tob(word) for word in words) for words in (key, signature, message)]
+    except OverflowError:
+        return False
+    return verify(key, signature, message)
+
+def verifymany(items):
+    """verify() for a list of (key, signature, message), in order of key so
+    the signatures of a key are checked together while it is cached"""
+    results = [False] * len(items)
+    for i in sorted(range(len(items)), key=lambda i: bytes(items[i][0])):
+        results[i] = verify(*items[i])
+    return results
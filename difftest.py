@@ -0,0 +1,85 @@
+"""Differential test of the dispatch engine against the reference interpreter.
+
+Usage: python difftest.py [<file or directory>...]   (default: et/)
+
+Compiles every .et and .as file, then runs both engines one step at a time
+and compares the serialized states after every step. The REGRESSIONS run
+first and also have to end like they did in the original interpreter."""
+
+import os
+import io
+import sys
+import contextlib
+
+from vm import load, dump, execute, dispatch, STATUS, STATI, NORMAL, RECURSE, GAS, MEM
+
+def compilefile(path):
+    """Returns the flat state for a .et or .as file"""
+    with open(path) as f:
+        text = f.read()
+    # The compiler is chatty
+    with contextlib.redirect_stdout(io.StringIO()):
+        if path.endswith(".as"):
+            from assembler import assemble
+            code = assemble(text)
+            return [0,0,0,0,0,len(code),0,0,0] + code
+        from parser import parse
+        return parse(text)
+
+def compare(state, gas=10000, mem=1000000, steps=100000, engines=(execute, dispatch)):
+    """Runs state on all engines in lockstep. Returns the number of steps and
+    the final flat state, raises AssertionError at the first difference"""
+    state = list(state)
+    state[STATUS] = NORMAL
+    state[GAS] = gas
+    state[MEM] = mem
+    chains = [load(state) for engine in engines]
+    count = 0
+    while count < steps and chains[0][0][0][STATUS] in [NORMAL, RECURSE]:
+        for engine, states in zip(engines, chains):
+            engine(states, 1)
+        count += 1
+        flats = [dump(states) for states in chains]
+        for engine, flat in zip(engines[1:], flats[1:]):
+            assert flat == flats[0], "%s differs after step %i" % (engine.__name__, count)
+    return count, flats[0] if count else state
+
+# Name, flat state, gas, mem and the final state of the original interpreter
+REGRESSIONS = [
+    # KEYGET pushes a value of None instead of treating the key as missing
+    ("keyget-none", [0,0,0,0,0,8,0,0,0, 8,6,5,9,10,6,5,12], 100, 1000,
+        [5,0,72,472,8,8,1,2,0, 8,6,5,9,10,6,5,12, None, 5,None]),
+]
+
+def paths(args):
+    for arg in args:
+        if os.path.isdir(arg):
+            for name in sorted(os.listdir(arg)):
+                if name.endswith(".et") or name.endswith(".as"):
+                    yield os.path.join(arg, name)
+        else:
+            yield arg
+
+if __name__ == "__main__":
+    failed = False
+    for name, state, gas, mem, expected in REGRESSIONS:
+        try:
+            count, final = compare(state, gas, mem)
+            assert final == expected, "ends in %s instead of %s" % (final, expected)
+            print("%s\tok\t%i steps\t%s" % (name, count, STATI[final[STATUS]]))
+        except AssertionError as e:
+            failed = True
+            print("%s\tFAIL\t%s" % (name, e))
+    for path in paths(sys.argv[1:] or ["et"]):
+        try:
+            state = compilefile(path)
+        except Exception as e:
+            print("%s\tdoes not compile: %s" % (path, type(e).__name__))
+            continue
+        try:
+            count, final = compare(state)
+            print("%s\tok\t%i steps\t%s" % (path, count, STATI[final[STATUS]]))
+        except AssertionError as e:
+            failed = True
+            print("%s\tFAIL\t%s" % (path, e))
+    exit(1 if failed else 0)
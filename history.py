@@ -0,0 +1,59 @@
+"""Time travel for resident process chains.
+
+History takes a snapshot (see vm.snapshot) every `interval` steps while it runs
+a chain, and goes back to any earlier step by rolling back to the snapshot
+before it and replaying the rest. Memory areas are shared between snapshots
+until they are changed, so this is cheap even for large states.
+
+Usage: python history.py <file.et or .as> <step>...   prints the state after every given step"""
+
+import sys
+
+from vm import NORMAL, RECURSE, STATUS, GAS, MEM, load, dump, dispatch, snapshot, rollback
+
+class History:
+    """Runs a resident process chain, snapshotting it every `interval` steps"""
+
+    def __init__(self, states, interval=1000, engine=dispatch):
+        self.states = states
+        self.interval = interval
+        self.engine = engine
+        self.count = 0
+        # The snapshot after i * interval steps
+        self.snapshots = [snapshot(states)]
+
+    def running(self):
+        return self.states[0][0][STATUS] in [NORMAL, RECURSE]
+
+    def run(self, steps=None):
+        """Runs up to `steps` steps or until the top process stops, returns the number of steps"""
+        start = self.count
+        while self.running() and (steps is None or self.count - start < steps):
+            until = self.interval - self.count % self.interval
+            if steps is not None:
+                until = min(until, steps - (self.count - start))
+            self.count += self.engine(self.states, until)
+            if self.count % self.interval == 0 and self.count // self.interval == len(self.snapshots):
+                self.snapshots.append(snapshot(self.states))
+        return self.count - start
+
+    def goto(self, count):
+        """Brings the chain to the state after `count` steps (or where it stopped before)"""
+        if count < self.count:
+            index = min(count // self.interval, len(self.snapshots) - 1)
+            rollback(self.states, self.snapshots[index])
+            self.count = index * self.interval
+        self.run(count - self.count)
+
+if __name__ == "__main__":
+    from difftest import compilefile
+    state = compilefile(sys.argv[1])
+    state[STATUS] = NORMAL
+    state[GAS] = 10000
+    state[MEM] = 1000000
+    history = History(load(state), interval=100)
+    history.run()
+    print("stopped after %i steps" % history.count)
+    for arg in sys.argv[2:]:
+        history.goto(int(arg))
+        print("%i\t%s" % (history.count, dump(history.states)))
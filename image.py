@@ -0,0 +1,225 @@
+"""State images: flat states on disk that can be resumed without parsing.
+
+An image holds the words of a flat state as little-endian unsigned 64 bit
+integers, followed by a table with the offset of every memory area and the
+values that do not fit into 64 bits (see words.py):
+
+    magic, version, number of words, number of areas, number of escapes
+    words...
+    offset of the length word of every area...
+    index and offset of every escaped value, sorted by index...
+    escaped values: byte length (-1 for None), signed big-endian bytes padded to 8
+
+load() maps the file and deserializes the header, code, stack and map only.
+Memory areas stay views into the mapping until an instruction touches them.
+
+    states = image.load("big.img")
+    states[0][0][GAS] = 10000
+    vm.resume(states)
+    image.save("big.img", states[0][0])
+"""
+
+import os
+import sys
+import mmap
+import struct
+import bisect
+from array import array
+
+from vm import CODE, STACK, MAP, MEMORY, F_CODE, Map, entry, d
+from words import Words, ESCAPE
+
+MAGIC = b"RVMIMAGE"
+VERSION = 1
+HEADER = struct.Struct("<8sQQQQ")
+
+def encode(value):
+    """Bytes of an escaped value"""
+    if value is None:
+        return struct.pack("<q", -1)
+    length = (value.bit_length() + 8) // 8
+    return struct.pack("<q", length) + value.to_bytes(length, "big", signed=True).ljust((length + 7) // 8 * 8, b"\0")
+
+class Image:
+    """The words and escaped values of a mapped image file"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nwords, nareas, nescapes = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a state image" % path)
+        start = HEADER.size
+        self.words = self.section(start, nwords)
+        start += 8 * nwords
+        self.table = self.section(start, nareas)
+        start += 8 * nareas
+        escapes = self.section(start, 2 * nescapes)
+        self.escaped = escapes[0::2]
+        self.offsets = escapes[1::2]
+        self.blob = start + 16 * nescapes
+
+    def section(self, start, count):
+        """count words from byte offset start, mapped if the byte order allows"""
+        if sys.byteorder == "little":
+            return memoryview(self.mm)[start:start+8*count].cast("Q")
+        words = array("Q")
+        words.frombytes(self.mm[start:start+8*count])
+        words.byteswap()
+        return words
+
+    def __len__(self):
+        return len(self.words)
+
+    def escape(self, i, raw=False):
+        """The i-th escaped value, or its bytes if raw"""
+        offset = self.blob + self.offsets[i]
+        length, = struct.unpack_from("<q", self.mm, offset)
+        if raw:
+            return self.mm[offset:offset+8+max(0, (length + 7) // 8 * 8)]
+        if length < 0:
+            return None
+        return int.from_bytes(self.mm[offset+8:offset+8+length], "big", signed=True)
+
+    def escapes(self, start, end, raw=False):
+        """Indices and values of the escaped words in [start, end)"""
+        first = bisect.bisect_left(self.escaped, start)
+        last = bisect.bisect_left(self.escaped, end)
+        for i in range(first, last):
+            yield self.escaped[i], self.escape(i, raw)
+
+    def value(self, index):
+        word = self.words[index]
+        if word == ESCAPE:
+            return self.escape(bisect.bisect_left(self.escaped, index % len(self.words)))
+        return word
+
+    def values(self, start, end):
+        values = self.words[start:end].tolist()
+        for index, value in self.escapes(start, end):
+            values[index - start] = value
+        return values
+
+class Area:
+    """A memory area that is still in an image. Measures, iterates and reads
+    like a list, vm.flatarea converts it before it is changed"""
+
+    def __init__(self, image, start, length):
+        self.image = image
+        self.start = start
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.image.values(self.start, self.start + self.length))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, stride = index.indices(self.length)
+            if stride != 1:
+                return list(self)[index]
+            return self.image.values(self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("area index out of range")
+        return self.image.value(self.start + index)
+
+def load(path):
+    """Maps an image into a resident process chain (see vm.load). Only the
+    header, code, stack and map are read, memory areas are read when used"""
+    image = Image(path)
+    lens = image.values(F_CODE - 4, F_CODE)
+    state = image.values(0, CODE)
+    offset = F_CODE
+    for section in lens[:3]:
+        state.append(image.values(offset, offset + section))
+        offset += section
+    state[MAP] = Map(state[MAP])
+    state.append([Area(image, start + 1, image.value(start)) for start in image.table])
+    return [entry(state)]
+
+def read(path):
+    """Reads an image into a flat state, as Words"""
+    image = Image(path)
+    flat = Words(array("Q", image.words))
+    for index, value in image.escapes(0, len(image)):
+        flat[index] = value
+    return flat
+
+class Writer:
+    """Writes words to an image file, collecting the encoded values to escape"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.escapes = {}
+
+    def write(self, values):
+        if isinstance(values, Area) and sys.byteorder == "little":
+            image = values.image
+            end = values.start + values.length
+            self.f.write(image.words[values.start:end])
+            for index, data in image.escapes(values.start, end, raw=True):
+                self.escapes[self.count + index - values.start] = data
+            self.count += values.length
+            return
+        if not isinstance(values, list):
+            values = list(values)
+        try:
+            packed = array("Q", values)
+            if ESCAPE in packed:
+                raise OverflowError
+        except (OverflowError, TypeError):
+            packed = array("Q")
+            for i, value in enumerate(values):
+                if type(value) is int and 0 <= value < ESCAPE:
+                    packed.append(value)
+                else:
+                    packed.append(ESCAPE)
+                    self.escapes[self.count + i] = encode(value)
+        if sys.byteorder != "little":
+            packed.byteswap()
+        self.f.write(packed.tobytes())
+        self.count += len(values)
+
+def save(path, state):
+    """Writes a flat (list or Words) or nested state as an image. The file is
+    replaced at the end, so an image can be saved over the one it was loaded from"""
+    if not isinstance(state[CODE], (list, Map)):
+        state = d(state)
+    memory = state[MEMORY]
+    header = state[:CODE] + [len(state[CODE]), len(state[STACK]), len(state[MAP]), len(memory)]
+    nwords = len(header) + len(state[CODE]) + len(state[STACK]) + len(state[MAP]) + len(memory) + sum(len(area) for area in memory)
+
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, nwords, len(memory), 0))
+        writer = Writer(f)
+        writer.write(header)
+        writer.write(state[CODE])
+        writer.write(state[STACK])
+        writer.write(state[MAP])
+        table = []
+        for area in memory:
+            table.append(writer.count)
+            writer.write([len(area)])
+            writer.write(area)
+        assert writer.count == nwords
+        f.write(struct.pack("<%iQ" % len(table), *table))
+        blob = []
+        offset = 0
+        for index in sorted(writer.escapes):
+            data = writer.escapes[index]
+            f.write(struct.pack("<QQ", index, offset))
+            blob.append(data)
+            offset += len(data)
+        f.write(b"".join(blob))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, nwords, len(memory), len(writer.escapes)))
+    os.replace(temp, path)
@@ -0,0 +1,90 @@
+"""Checks the peephole optimizer (see assembler.peephole) and reports the gas it saves.
+
+Usage: python opttest.py [--registers] [<file or directory>...]   (default: et/)
+
+Compiles every .et and .as file with and without the optimizer (or, with
+--registers, with and without keeping loop variables on the stack), runs both
+until they stop and compares the final states except for gas, mem, the
+instruction pointer and the code. Runs that end out of gas or memory are
+only compared if both do, runs that do not stop within the step limit are
+not compared (gas can skip 0, a negative GAS never runs out)."""
+
+import io
+import sys
+import contextlib
+
+from vm import load, dump, dispatch, d, STATUS, STATI, NORMAL, RECURSE, REC, GAS, MEM, STACK, MAP, MEMORY, CODE, OOG, OOM
+from difftest import paths
+
+def compileboth(path, registers=False):
+    """Flat states for a .et or .as file without and with the optimizer, or
+    with the optimizer without and with registers (see regalloc.py)"""
+    with open(path) as f:
+        text = f.read()
+    options = [dict(optimize=False), dict()]
+    if registers:
+        options = [dict(), dict(registers=True)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        if path.endswith(".as"):
+            from assembler import assemble
+            return [[0,0,0,0,0,len(code),0,0,0] + code for code in (assemble(text, **kwargs) for kwargs in options)]
+        from parser import parse
+        return [parse(text, **kwargs) for kwargs in options]
+
+def observable(state):
+    """The parts of a flat state the optimizer must not change"""
+    state = d(state)
+    return [state[STATUS], state[REC], state[STACK], state[MAP], state[MEMORY]]
+
+def finish(state, gas, mem, steps):
+    """Runs a flat state for up to steps steps, returns the flat state"""
+    state = list(state)
+    state[STATUS] = NORMAL
+    state[GAS] = gas
+    state[MEM] = mem
+    states = load(state)
+    dispatch(states, steps)
+    return dump(states)
+
+def compare(plain, optimized, gas=100000, mem=10**12, steps=100000):
+    """Runs both states. Returns the final states, raises AssertionError if
+    they differ in more than gas, mem, instruction pointer and code"""
+    finals = [finish(state, gas, mem, steps) for state in (plain, optimized)]
+    stati = [final[STATUS] for final in finals]
+    running = [status in [NORMAL, RECURSE] for status in stati]
+    if running[0] or running[1]:
+        stopped = stati[running.index(False)] if False in running else OOG
+        assert stopped in [OOG, OOM], "%s stops with %s" % (["unoptimized", "optimized"][running.index(False)], STATI[stopped])
+    elif OOG in stati or OOM in stati:
+        assert stati[0] == stati[1], "ends %s instead of %s" % (STATI[stati[1]], STATI[stati[0]])
+    else:
+        assert observable(finals[0]) == observable(finals[1]), "final states differ"
+    return finals
+
+if __name__ == "__main__":
+    gas = 100000
+    mem = 10**12
+    registers = "--registers" in sys.argv
+    failed = False
+    print("file\tstatus\tcode\tgas\tgas saved\tmem")
+    for path in paths([arg for arg in sys.argv[1:] if arg != "--registers"] or ["et"]):
+        try:
+            plain, optimized = compileboth(path, registers)
+        except Exception as e:
+            print("%s\tdoes not compile: %s" % (path, type(e).__name__))
+            continue
+        sizes = "%i->%i" % (len(d(plain)[CODE]), len(d(optimized)[CODE]))
+        try:
+            finals = compare(plain, optimized, gas, mem)
+        except AssertionError as e:
+            failed = True
+            print("%s\tFAIL\t%s\t%s" % (path, sizes, e))
+            continue
+        if finals[0][STATUS] in [NORMAL, RECURSE]:
+            print("%s\truns on\t%s" % (path, sizes))
+            continue
+        used = [gas - final[GAS] for final in finals]
+        saved = used[0] - used[1]
+        mems = [mem - final[MEM] for final in finals]
+        print("%s\t%s\t%s\t%i->%i\t%i (%.1f%%)\t%i->%i" % (path, STATI[finals[0][STATUS]], sizes, used[0], used[1], saved, 100 * saved / used[0] if used[0] else 0, mems[0], mems[1]))
+    exit(1 if failed else 0)
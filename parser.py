@@ -1,7 +1,8 @@
 from lark.lark import Lark, Tree
+from lark.lexer import Token
 from lark.visitors import Transformer
-from assembler import assemble
-from vm import d, s, STACK, MEMORY
+from assembler import assemble, decode, fold
+from vm import d, s, STACK, MEMORY, REQS, PUSH, POP, DUP, FLIP, ADD, SUB, MUL, DIV, MOD, NOT, READ, WRITE
 import inspect
 grammar = r"""
 
@@ -24,11 +25,13 @@ start: (_NEWLINE | stmt)*
 
 
 ?stmt: simple_stmt | compound_stmt
-?simple_stmt: (flow_stmt | func_call | write_stmt | keyset_stmt | keydel_stmt | alloc_stmt | dealloc_stmt | dearea_stmt | macro_stmt | expand_stmt | expr_stmt) _NEWLINE
+?simple_stmt: (flow_stmt | func_call | write_stmt | memcpy_stmt | memset_stmt | keyset_stmt | keydel_stmt | alloc_stmt | dealloc_stmt | dearea_stmt | expand_stmt | expr_stmt) _NEWLINE
 ?expr_stmt: NAME "=" (test | expr) -> assign
           | test
 
 write_stmt: "$write" "(" expr "," expr "," expr ")"
+memcpy_stmt: "$memcpy" "(" expr "," expr "," expr "," expr "," expr ")"
+memset_stmt: "$memset" "(" expr "," expr "," expr "," expr ")"
 alloc_stmt: "$alloc" "(" expr "," expr ")"
 dealloc_stmt: "$dealloc" "(" expr ")"
 dearea_stmt: "$dearea" "(" expr ")"
@@ -37,8 +40,8 @@ keydel_stmt: "$keydel" "(" expr ")"
 ?flow_stmt: pass_stmt | meta_stmt | yield_stmt | return_stmt | halt_stmt | area_stmt
 pass_stmt: "pass"
 meta_stmt: "$meta"
-yield_stmt: "yield" [expr | NAME]
-return_stmt: "return" [expr | NAME]
+yield_stmt: "yield" [expr]
+return_stmt: "return" [expr]
 ?halt_stmt: "halt"
 ?area_stmt: "$area"
 macro_stmt: "macro" NAME ":" suite
@@ -71,10 +74,13 @@ func_call: NAME ["<" expr ["," expr] ">"] "(" [arglist] ")"
 func_stat: NAME "." stat
 stat: "status" | "ip"
 
-?primitive: stacklen | memorylen | arealen_expr | read_expr | sha256_expr | keyget_expr | keyhas_expr | malloc_expr | arg_expr
+?primitive: stacklen | memorylen | arealen_expr | read_expr | sha256_expr | ecverify_expr | memcmp_expr | memhash_expr | keyget_expr | keyhas_expr | malloc_expr | arg_expr
 arealen_expr: "$arealen" "(" expr ")"
 read_expr: "$read" "(" expr "," expr ")"
 sha256_expr: "$sha256" "(" expr ")"
+ecverify_expr: "$ecverify" "(" expr "," expr "," expr "," expr "," expr "," expr "," expr ")"
+memcmp_expr: "$memcmp" "(" expr "," expr "," expr "," expr "," expr ")"
+memhash_expr: "$memhash" "(" expr "," expr "," expr ")"
 malloc_expr: "$malloc" "(" expr ")"
 keyhas_expr: "$keyhas" "(" expr ")"
 keyget_expr: "$keyget" "(" expr ")"
@@ -90,7 +96,7 @@ subscript: test
 arglist: (argument ",")* (argument [","])
 argument: expr
 
-?compound_stmt: if_stmt | while_stmt | funcdef | struct
+?compound_stmt: if_stmt | while_stmt | funcdef | struct | macro_stmt
 if_stmt: "if" test ":" suite ["else" ":" suite]
 suite: _NEWLINE _INDENT _NEWLINE? stmt+ _DEDENT _NEWLINE?
 
@@ -116,28 +122,78 @@ def isint(v):
         return False
 
 
-def indent(line):
-    return (len(line) - len(line.lstrip(' '))) // 4
+class Indentation:
+    """Turns indentation into _INDENT and _DEDENT tokens. A level is four
+    spaces or one tab, a program may use one or the other. Blank and comment
+    lines do not change the level. Indentation that mixes tabs and spaces
+    raises an IndentationError with the line number.
 
+    As a Lark postlexer (see getparser) it adds the tokens after every
+    _NEWLINE, prep() writes them into the text as <INDENT> and <DEDENT>"""
 
-def prep(code):
-    code = code.split('\n')
-    code.append('\n')
-    current = 0
-    lines = ''
-    for line in code:
-        ind = indent(line)
-        if ind > current:
-            prefix = '<INDENT>' * (ind - current)
-        else:
-            if ind < current:
-                prefix = '<DEDENT>' * (current - ind)
+    always_accept = ("_NEWLINE",)
+
+    def __init__(self):
+        self.char = None
+
+    def level(self, whitespace, number):
+        """The level of a line (number counts from 1) indented with whitespace"""
+        if not whitespace:
+            return 0
+        char = whitespace[0]
+        if whitespace.strip(char):
+            raise IndentationError("line %i: indentation mixes tabs and spaces" % number)
+        if self.char is None:
+            self.char = char
+        elif char != self.char:
+            raise IndentationError("line %i: indented with %s, earlier lines with %s" % (number, *[{" ": "spaces", "\t": "tabs"}.get(c, repr(c)) for c in (char, self.char)]))
+        return len(whitespace) if char == "\t" else len(whitespace) // 4
+
+    def process(self, stream):
+        self.char = None
+        current = 0
+        for token in stream:
+            yield token
+            if token.type != "_NEWLINE":
+                continue
+            level = self.level(token.rsplit("\n", 1)[1], token.end_line)
+            for i in range(current, level):
+                yield Token.new_borrow_pos("_INDENT", "<INDENT>", token)
+            for i in range(level, current):
+                yield Token.new_borrow_pos("_DEDENT", "<DEDENT>", token)
+            current = level
+        for i in range(current):
+            yield Token("_DEDENT", "<DEDENT>")
+
+    def lines(self, code):
+        """The lines of code without indentation, each starting with the
+        <INDENT> or <DEDENT> markers that lead to it"""
+        self.char = None
+        current = level = 0
+        last = ""
+        for number, line in enumerate(code.split("\n"), 1):
+            text = line.lstrip(" \t")
+            if not text or text[0] == "#" or text.isspace():
+                yield text + "\n"
+                continue
+            whitespace = line[:len(line)-len(text)]
+            if whitespace != last:
+                level = self.level(whitespace, number)
+                last = whitespace
+            if level == current:
+                yield text + "\n"
+                continue
+            if level > current:
+                yield "<INDENT>" * (level - current) + text + "\n"
             else:
-                prefix = ''
-        current = ind
-        lines += prefix + line.lstrip() + '\n'
+                yield "<DEDENT>" * (current - level) + text + "\n"
+            current = level
+        yield "<DEDENT>" * current + "\n"
+
 
-    return lines.replace("<DEDENT>\n<INDENT>", "")
+def prep(code):
+    """code with its indentation replaced by <INDENT> and <DEDENT> markers"""
+    return "".join(Indentation().lines(code))
 
 
 class Allocator:
@@ -203,6 +259,84 @@ def varint(node):
             return ['PUSH %i' % int(node.children[0].value)]
         raise Exception('Fail')
 
+def constant(node):
+    """The value of an expression that is known at compile time, None if it is not"""
+    if isinstance(node, Meta):
+        node = node.code
+    if isinstance(node, list):
+        if len(node) == 1 and isinstance(node[0], str) and node[0].startswith("PUSH ") and isint(node[0][5:]):
+            return int(node[0][5:])
+        return None
+    if isinstance(node, Tree) and node.data == 'number' and node.children[0].type == 'DEC_NUMBER':
+        return int(node.children[0].value)
+    return None
+
+def operation(first, rest, optimize=True):
+    """Code for first followed by the (opcodes, operand) pairs in rest, left
+    to right. With optimize, operations on constants are computed at compile
+    time like the VM would, except those that would fail (division by 0)"""
+    out = Meta()
+    value = constant(first) if optimize else None
+    if value is None:
+        out += varint(first)
+    for ops, operand in rest:
+        if value is not None:
+            b = constant(operand)
+            folded = None if b is None else fold(ops[0], value, b)
+            for op in ops[1:]:
+                folded = None if folded is None else fold(op, folded)
+            if folded is not None:
+                value = folded
+                continue
+            out.append("PUSH %i" % value)
+            value = None
+        out += varint(operand)
+        for op in ops:
+            out.append(REQS[op][0])
+    if value is not None:
+        out.append("PUSH %i" % value)
+    return out
+
+def evaluate(code, mem):
+    """Runs the start of lowered code at compile time for as long as it only
+    computes with constants and reads and writes variables at constant
+    addresses in memory area 0, whose initial contents are mem. Values written
+    are stored in mem. Returns the rest of the code, which starts with the
+    values left on the stack. Code with RETURN starts over from the beginning
+    and is returned unchanged"""
+    if "RETURN" in code:
+        return code
+    stack = []
+    done = 0
+    for line in code:
+        if not isinstance(line, str):
+            break
+        instructions = decode([line])
+        if len(instructions) != 1:
+            break
+        op, arg = instructions[0]
+        if op == PUSH and type(arg) is int:
+            stack.append(arg)
+        elif op in [ADD, SUB, MUL, DIV, MOD] and len(stack) >= 2 and fold(op, stack[-2], stack[-1]) is not None:
+            stack[-2:] = [fold(op, stack[-2], stack[-1])]
+        elif op == NOT and stack:
+            stack[-1] = fold(NOT, stack[-1])
+        elif op == DUP and stack:
+            stack.append(stack[-1])
+        elif op == FLIP and len(stack) >= 2:
+            stack[-2:] = [stack[-1], stack[-2]]
+        elif op == POP and stack:
+            stack.pop()
+        elif op == READ and len(stack) >= 2 and stack[-2] == 0 and 0 <= stack[-1] < len(mem):
+            stack[-2:] = [mem[stack[-1]]]
+        elif op == WRITE and len(stack) >= 3 and stack[-3] == 0 and 0 <= stack[-2] < len(mem):
+            mem[stack[-2]] = stack[-1]
+            del stack[-3:]
+        else:
+            break
+        done += 1
+    return ["PUSH %i" % value for value in stack] + code[done:]
+
 class Meta:
 
     def __init__(self):
@@ -227,113 +361,156 @@ class Meta:
             raise Exception("Unknown combinator %s", other)
         return self
 
-    def final(self):
+    def final(self, debug=False, optimize=True, registers=False):
         header = [0, 0, 0, 0, 0]
-        #print(self.code)
         memory = []
         mapp = []
         allocator = Allocator()
         typedefs = {}
 
-        offset = 0
-        #for offset, instruction in enumerate(self.code):
-        while offset < len(self.code):
-            #print(self.code)
-            instr = self.code[offset]
-            print(offset, instr)
-
-            updateoffset = True
-
-            def insertList(lst):
-                nonlocal updateoffset
-                updateoffset = False
-                self.code = self.code[:offset]+lst+self.code[offset+1:]
-
-            insertindex = offset
-            def insert(node):
-                nonlocal updateoffset
-                updateoffset = False
-                nonlocal insertindex
-                if insertindex == offset:
-                    self.code[insertindex] = node
-                else:
-                    self.code.insert(insertindex, node)
-                insertindex += 1
+        # Lowers the nodes left to right. Expansions are pushed back onto the
+        # worklist (reversed, it is popped from the end) and lowered in turn,
+        # so every node is handled once
+        code = []
+        worklist = list(reversed(self.code))
+        while worklist:
+            instr = worklist.pop()
+            if debug:
+                print(len(code), instr)
 
-            def ignore():
-                nonlocal updateoffset
-                updateoffset = False
-                self.code = self.code[:offset] + self.code[offset+1:]
+            def expand(lst):
+                worklist.extend(reversed(lst))
 
             if isinstance(instr, str):
-                pass
+                code.append(instr)
             elif isinstance(instr, list):
-                insertList(instr)
+                expand(instr)
             elif isinstance(instr, Meta):
-                insertList(instr.code)
+                expand(instr.code)
             elif isinstance(instr, Struct):
                 typedefs[instr.name] = instr.kv
-                ignore()
             elif isinstance(instr, Assign):
-                #print("assign")
-                # Can optimize fixed assignments
-                insert("PUSH 0")
+                # Fixed assignments at the start are made at compile time, see evaluate
                 pointer = allocator.getOrReserveVariable(instr.a)
-                insert("PUSH %i" % pointer)
+                lowered = ["PUSH 0", "PUSH %i" % pointer]
                 if isinstance(instr.b, str):
                     # good enough for now, have to store unicode code points later
                     objpointer = allocator.reserve(list(instr.b[1:-1].encode("utf8"))+[0])
-                    insert("PUSH %i" % objpointer)
+                    lowered.append("PUSH %i" % objpointer)
                 else:
-                    print(instr.b)
-                    insert(varint(instr.b))
-                insert("WRITE")
+                    if debug:
+                        print(instr.b)
+                    lowered.append(varint(instr.b))
+                lowered.append("WRITE")
+                expand(lowered)
 
             elif isinstance(instr, Expand):
                 if instr.name in self.macros:
-                    print(self.macros[instr.name].code)
-                    insertList(self.macros[instr.name].code)
+                    if debug:
+                        print(self.macros[instr.name].code)
+                    expand(self.macros[instr.name].code)
                 else:
                     raise Exception("Invalid macro name %s" % instr.name)
 
             elif isinstance(instr, Function):
                 memory.append(instr.obj)
                 mapp.append([word_from_name(instr.name), len(memory)])
+                code.append(instr)
 
             elif isinstance(instr, FunctionCall):
                 name = word_from_name(instr.name)
                 if name in [kv[0] for kv in mapp]:
                     index = [kv for kv in mapp if kv[0]==name][0][1]
-                    insertList(self.while_stmt([
+                    expand(self.while_stmt([
                         self.comparison(["PUSH %i" % index, "PUSH 0", "READ"],
                         ["PUSH %i" % index, "RUN"])]))
                 else:
                     raise Exception("Unknown function name %s" % instr.name)
 
             elif isinstance(instr, ComplexValue):
-                insertList(["PUSH 0", "PUSH %i" % allocator.getVariable(instr.value), "READ"])
+                expand(["PUSH 0", "PUSH %i" % allocator.getVariable(instr.value), "READ"])
             else:
-                print(instr)
-                raise Exception('Unknown instr type')
-
-            if updateoffset:
-                offset += 1
+                raise Exception('Unknown instr type %s' % instr)
 
+        if optimize:
+            code = evaluate(code, allocator.mem)
+        self.code = code
         memory = [allocator.mem] + memory
-        print("\n".join(self.code))
-        print(typedefs)
-        code = assemble(self.code)
+        if debug:
+            print("\n".join(self.code))
+            print(typedefs)
+        code = assemble(self.code, optimize, registers)
         stack = []
 
-        #print(code)
         sharp = header + [code, stack, mapp, memory]
         flat = s(sharp)
-        #print(flat)
         return flat
 
 
 
 
+def fingerprint(meta):
+    """Bytes that identify what meta.final() compiles: its nodes and the code
+    of the macros they expand, used as the compile cache key of funcdef bodies.
+    Node attributes are serialized by content, they may hold Metas whose repr
+    is only an address"""
+    parts = []
+    seen = set()
+    def walk(value):
+        if isinstance(value, Meta):
+            parts.append("meta[")
+            walk(value.code)
+            parts.append("]")
+        elif isinstance(value, (list, tuple)):
+            parts.append("[")
+            for item in value:
+                walk(item)
+            parts.append("]")
+        elif isinstance(value, dict):
+            parts.append("{")
+            for key in sorted(value, key=repr):
+                parts.append(repr(key))
+                walk(value[key])
+            parts.append("}")
+        elif isinstance(value, Tree):
+            parts.append("tree %r[" % value.data)
+            walk(value.children)
+            parts.append("]")
+        elif isinstance(value, Token):
+            parts.append("token %r %r" % (value.type, str(value)))
+        elif isinstance(value, Node):
+            parts.append("%s(" % type(value).__name__)
+            for name, attr in sorted(vars(value).items()):
+                parts.append(name)
+                walk(attr)
+            parts.append(")")
+            if isinstance(value, Expand) and value.name in meta.macros and value.name not in seen:
+                seen.add(value.name)
+                parts.append("macro %s:" % value.name)
+                walk(meta.macros[value.name].code)
+        else:
+            parts.append(repr(value))
+    walk(meta.code)
+    return "\n".join(parts).encode("utf8")
+
+# Parsers are built once per algorithm, see getparser
+PARSERS = {}
+
+def getparser(algorithm="earley", cache=False):
+    """Returns the Lark parser for the grammar, built on first use.
+    algorithm is "earley" or "lalr", the grammar works with both. LALR reads
+    the source with the Indentation postlexer, Earley the text of prep().
+    LALR tables can be cached on disk: cache is True for a file in the
+    temporary directory or a path, and is only used when the parser is built"""
+    if algorithm not in PARSERS:
+        if algorithm == "lalr":
+            PARSERS[algorithm] = Lark(grammar, parser="lalr", postlex=Indentation(), cache=cache)
+        elif algorithm == "earley":
+            PARSERS[algorithm] = Lark(grammar, debug=True)
+        else:
+            raise ValueError("Unknown parser algorithm %s" % algorithm)
+    return PARSERS[algorithm]
+
 class Generator:
 
     def __init__(self):
@@ -350,7 +527,12 @@ class Generator:
         return 'name:%i' % self.next()
 
 
-def parse(code, generator=None):
+def parse(code, generator=None, algorithm="earley", cache=None, optimize=True, registers=False):
+    """Compiles Entish code to a flat state. cache is an optional
+    compilecache.CompileCache for the program and its function bodies,
+    optimize runs the peephole optimizer (see assembler.peephole) and
+    registers keeps loop variables on the stack (see regalloc.py)"""
+    options = ("" if optimize else "unoptimized ") + ("registers " if registers else "")
     if generator is None:
         generator = Generator()
 
@@ -359,7 +541,7 @@ def parse(code, generator=None):
         def start(self, node):
             intro = Meta()
             m = sum(node, intro)
-            return m.final()
+            return m.final(optimize=optimize, registers=registers)
 
         def struct(self, node):
             out = Meta()
@@ -377,7 +559,12 @@ def parse(code, generator=None):
 
             print(node)
             out = Meta()
-            out.append(Function(node[0].value, node[1], fun.final()))
+            build = lambda: fun.final(optimize=optimize, registers=registers)
+            if cache:
+                obj = cache.compile(options + "function", fingerprint(fun), build)
+            else:
+                obj = build()
+            out.append(Function(node[0].value, node[1], obj))
 
             return out
 
@@ -480,29 +667,15 @@ def parse(code, generator=None):
             return out
 
         def comparison(self, node):
-            out = Meta()
-            out += varint(node[0])
-            out += varint(node[2])
-            out.append('SUB')
-            if node[1].value == '!=':
-                out.append('NOT')
-            return out
+            return operation(node[0], [({'==':[SUB],  '!=':[SUB, NOT]}[node[1].value], node[2])], optimize)
 
         def term(self, node):
-            out = Meta()
-            out += varint(node[0])
-            out += varint(node[2])
-            out.append('%s' % {'*':'MUL',  '/':'DIV',  '%':'MOD'}[node[1].value])
-            return out
+            ops = [{'*':[MUL],  '/':[DIV],  '%':[MOD]}[op.value] for op in node[1::2]]
+            return operation(node[0], list(zip(ops, node[2::2])), optimize)
 
         def arith_expr(self, node):
-            out = Meta()
-            out += varint(node[0])
-            for i in range((len(node) - 1) // 2):
-                out += varint(node[1 + i * 2 + 1])
-                out.append('%s' % {'+':'ADD',  '-':'SUB',  '~':'NOT'}[node[1 + i * 2].value])
-
-            return out
+            ops = [{'+':[ADD],  '-':[SUB],  '~':[NOT]}[op.value] for op in node[1::2]]
+            return operation(node[0], list(zip(ops, node[2::2])), optimize)
 
         def arealen_expr(self, node):
             out = varint(node[0])
@@ -524,6 +697,41 @@ def parse(code, generator=None):
             out.append('WRITE')
             return out
 
+        def memcpy_stmt(self, node):
+            out = Meta()
+            for arg in node:
+                out += varint(arg)
+            out.append('MEMCPY')
+            return out
+
+        def memset_stmt(self, node):
+            out = Meta()
+            for arg in node:
+                out += varint(arg)
+            out.append('MEMSET')
+            return out
+
+        def memcmp_expr(self, node):
+            out = Meta()
+            for arg in node:
+                out += varint(arg)
+            out.append('MEMCMP')
+            return out
+
+        def memhash_expr(self, node):
+            out = Meta()
+            for arg in node:
+                out += varint(arg)
+            out.append('MEMHASH')
+            return out
+
+        def ecverify_expr(self, node):
+            out = Meta()
+            for arg in node:
+                out += varint(arg)
+            out.append('ECVERIFY')
+            return out
+
         def keyset_stmt(self, node):
             out = Meta()
             out += varint(node[0])
@@ -596,17 +804,38 @@ def parse(code, generator=None):
 
             return m
 
-    l = Lark(grammar, debug=True)
-    prepped = prep(code)
-    print(prepped)
-    parsed = l.parse(prepped)
-    obj = MyTransformer().transform(parsed)
-    return obj
+    def build():
+        if algorithm == "lalr":
+            # The postlexer indents, the text needs a newline after every statement
+            parsed = getparser(algorithm).parse(code + "\n")
+        else:
+            prepped = prep(code)
+            print(prepped)
+            parsed = getparser(algorithm).parse(prepped)
+        return MyTransformer().transform(parsed)
+
+    if cache is not None:
+        return cache.compile(options + "program", code, build)
+    return build()
 
 if __name__ == "__main__":
     import sys
     if len(sys.argv) < 2:
         print("missing <file>")
         exit(1)
+    # --lalr parses with LALR, --cache <file> keeps its tables on disk
+    algorithm = "earley"
+    if "--lalr" in sys.argv:
+        algorithm = "lalr"
+        if "--cache" in sys.argv:
+            getparser("lalr", sys.argv[sys.argv.index("--cache")+1])
+    # --compile-cache <dir> keeps compiled programs and function bodies
+    cache = None
+    if "--compile-cache" in sys.argv:
+        from compilecache import CompileCache
+        cache = CompileCache(sys.argv[sys.argv.index("--compile-cache")+1])
+    # --registers keeps loop variables on the stack
     with open(sys.argv[1], "r") as f:
-        print(parse(f.read()))
+        print(parse(f.read(), algorithm=algorithm, cache=cache, registers="--registers" in sys.argv))
+    if cache is not None:
+        print(cache.stats())
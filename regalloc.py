@@ -0,0 +1,190 @@
+"""Keeps a loop variable on the stack instead of in memory.
+
+Variables live in memory area 0 at fixed addresses (see parser.Allocator). A
+read compiles to PUSH 0, PUSH addr, READ and an assignment to PUSH 0, PUSH
+addr, <value>, WRITE. For every innermost while loop, allocate() picks the
+variable that saves the most gas when it stays on top of the stack while the
+loop runs:
+
+    read                        DUP
+    assignment                  <value> FLIP POP
+    assignment v = v ...        <value without the read of v>
+
+It is read from memory before the loop and written back after it, unless it
+is assigned before it is read again (see live). DUP and FLIP only reach the
+two values on top of the stack, so a variable can only be kept there if the
+loop reads it at the start of statements and expressions. Loops are left
+alone if that is not the case, if they do not save gas after `trips`
+iterations, or if they look at their own stack (STACKLEN, KEYGET), shrink or
+remove memory areas, use bulk memory instructions or ECVERIFY or stop the
+process on purpose (HALT, YIELD, RETURN).
+
+Memory accessed with computed addresses ($read and $write with pointers from
+$malloc) is assumed not to hold variables. A process that stops inside such a
+loop, out of gas for example, has the variable on its stack, not in memory."""
+
+from vm import REQS, HALT, RETURN, YIELD, JUMP, JZ, PUSH, POP, DUP, FLIP, KEYGET, STACKLEN, READ, WRITE, AREA, DEAREA, DEALLOC, ECVERIFY, MEMCPY, MEMSET, MEMCMP, MEMHASH
+from assembler import LABEL
+
+# Instructions a loop with a variable on the stack may not contain. Bulk
+# memory instructions and ECVERIFY may read the variable in memory
+BARRIERS = [HALT, RETURN, YIELD, KEYGET, STACKLEN, DEAREA, DEALLOC, ECVERIFY, MEMCPY, MEMSET, MEMCMP, MEMHASH]
+
+def gas(*ops):
+    return sum(REQS[op][4] for op in ops)
+
+# Gas saved every time an access runs, and spent once around the loop
+READSAVED = gas(PUSH, PUSH, READ) - gas(DUP)
+WRITESAVED = gas(PUSH, PUSH, WRITE) - gas(FLIP, POP)
+UPDATESAVED = gas(PUSH, PUSH, READ) + gas(PUSH, PUSH, WRITE)
+LOAD = gas(PUSH, PUSH, READ)
+STORE = gas(PUSH, FLIP, PUSH, FLIP, WRITE)
+DROP = gas(POP)
+
+# Values taken from and put on the stack where REQS does not tell
+EFFECTS = {PUSH: (0, 1), POP: (1, 0), DUP: (1, 2), FLIP: (2, 2), AREA: (0, 0)}
+
+def effect(op):
+    """Values an instruction takes from and puts on the stack"""
+    if op in EFFECTS:
+        return EFFECTS[op]
+    return REQS[op][2], REQS[op][2] + REQS[op][3]
+
+def constant(instructions, i):
+    """The int pushed by instructions[i], None if it is not a constant"""
+    if i is not None and instructions[i][0] == PUSH and type(instructions[i][1]) is int:
+        return instructions[i][1]
+    return None
+
+def scan(instructions, start, end):
+    """Runs instructions[start:end] symbolically from an unknown stack.
+    Returns the reads and writes of constant addresses in area 0 as
+    (address, index of the PUSH of the area, stack depth there), None if the
+    code takes values from below its starting stack, jumps or has labels with
+    values on the stack or contains a barrier"""
+    # The index of the instruction that put each value on the stack
+    stack = []
+    reads = []
+    writes = []
+    for i in range(start, end):
+        op, arg = instructions[i]
+        if op is LABEL:
+            if stack:
+                return None
+            continue
+        if op in BARRIERS:
+            return None
+        pops, pushes = effect(op)
+        if len(stack) < pops:
+            return None
+        args = stack[len(stack)-pops:]
+        del stack[len(stack)-pops:]
+        if op in [READ, WRITE] and constant(instructions, args[0]) == 0:
+            address = constant(instructions, args[1])
+            if address is not None:
+                access = (address, args[0], len(stack), args[1] == args[0] + 1)
+                (reads if op == READ else writes).append(access + (i,))
+        if op == DUP:
+            stack += [args[0], i]
+        elif op == FLIP:
+            stack += [args[1], args[0]]
+        else:
+            stack += [i] * pushes
+        if op in [JZ, JUMP] and stack:
+            return None
+    return reads, writes
+
+def loops(instructions):
+    """(start, end) of every innermost while loop: from its label to the label
+    after the jump back, the loop is left by a JZ to that label only"""
+    labels = {arg: i for i, (op, arg) in enumerate(instructions) if op is LABEL}
+    pushed = {}
+    for op, arg in instructions:
+        if op == PUSH and type(arg) is not int:
+            pushed[arg] = pushed.get(arg, 0) + 1
+    found = []
+    for j in range(len(instructions) - 2):
+        (op, start), (jump, _), (label, end) = instructions[j:j+3]
+        if op != PUSH or jump != JUMP or label is not LABEL or start not in labels or labels[start] >= j:
+            continue
+        if pushed.get(start) != 1 or pushed.get(end) != 1:
+            continue
+        i = labels[start]
+        if not any(instructions[k] == [PUSH, end] and instructions[k+1][0] == JZ for k in range(i, j)):
+            continue
+        found.append((i, j + 2))
+    return [(i, j) for i, j in found if not any(i < k < j for k, l in found)]
+
+def live(instructions, start, address):
+    """Whether the variable at address may be read from start on. It is dead
+    if it is assigned a value that does not read it before any read, label,
+    jump or the end of the code (the final memory is the result)"""
+    end = start
+    while end < len(instructions) and instructions[end][0] not in [LABEL, JUMP, JZ, HALT, RETURN, YIELD]:
+        end += 1
+    if end == len(instructions):
+        return True
+    accesses = scan(instructions, start, end)
+    if accesses is None:
+        return True
+    reads, writes = accesses
+    for addr, area, depth, pushed, i in writes:
+        if addr == address:
+            return any(r[0] == address and r[4] < i for r in reads)
+    return True
+
+def choose(instructions, start, end, trips):
+    """The variable to keep on the stack in a loop and the accesses to rewrite,
+    None if there is none that saves gas"""
+    accesses = scan(instructions, start + 1, end)
+    if accesses is None:
+        return None
+    reads, writes = accesses
+    best = None
+    for address in set(access[0] for access in reads + writes):
+        myreads = [r for r in reads if r[0] == address]
+        mywrites = [w for w in writes if w[0] == address]
+        # Writes at the start of a statement, with the area and address pushed right before the value
+        if not all(depth == 0 and pushed for addr, area, depth, pushed, i in mywrites):
+            continue
+        updates = [w for w in mywrites if any(r[1] == w[1] + 2 for r in myreads)]
+        plain = [r for r in myreads if not any(r[1] == w[1] + 2 for w in updates)]
+        # Reads at the start of an expression, as PUSH 0, PUSH address, READ
+        if not all(depth == 0 and pushed and i == area + 2 for addr, area, depth, pushed, i in plain):
+            continue
+        if not all(r[4] == r[1] + 2 for r in myreads):
+            continue
+        saved = trips * (len(plain) * READSAVED + (len(mywrites) - len(updates)) * WRITESAVED + len(updates) * UPDATESAVED)
+        spent = LOAD + (STORE if live(instructions, end + 1, address) else DROP)
+        if saved > spent and (best is None or saved - spent > best[0]):
+            best = (saved - spent, address, plain, mywrites, updates)
+    return best
+
+def allocate(instructions, trips=10):
+    """Keeps a variable of every innermost while loop on the stack where that
+    saves gas, assuming every loop runs `trips` times. Returns new instructions"""
+    instructions = [list(instr) for instr in instructions]
+    for start, end in reversed(loops(instructions)):
+        chosen = choose(instructions, start, end, trips)
+        if chosen is None:
+            continue
+        saved, address, reads, writes, updates = chosen
+        replaced = {}
+        for addr, area, depth, pushed, i in reads:
+            replaced[area] = [[DUP, None]]
+            replaced[area + 1] = replaced[i] = []
+        for addr, area, depth, pushed, i in writes:
+            replaced[area] = replaced[area + 1] = []
+            replaced[i] = [[FLIP, None], [POP, None]]
+            if any(w[1] == area for w in updates):
+                # The value starts with the variable, and replaces it
+                replaced[area + 2] = replaced[area + 3] = replaced[area + 4] = replaced[i] = []
+        if live(instructions, end + 1, address):
+            after = [[PUSH, 0], [FLIP, None], [PUSH, address], [FLIP, None], [WRITE, None]]
+        else:
+            after = [[POP, None]]
+        body = []
+        for i in range(start, end + 1):
+            body += replaced.get(i, [instructions[i]])
+        instructions[start:end+1] = [[PUSH, 0], [PUSH, address], [READ, None]] + body + after
+    return instructions
@@ -1,16 +1,52 @@
 from sys import argv
 
-with open(argv[1]) as f:
-    code = f.read()
+if argv[1].endswith(".img"):
+    # A state image saved with --save (see image.py)
+    from image import read
+    state = read(argv[1]).tolist()
+else:
+    with open(argv[1]) as f:
+        code = f.read()
 
-from parser import parse
-state = parse(code)
+    from parser import parse
+    # --compile-cache <dir> loads unchanged programs instead of compiling them
+    cache = None
+    if "--compile-cache" in argv:
+        from compilecache import CompileCache
+        cache = CompileCache(argv[argv.index("--compile-cache")+1])
+    # --registers keeps loop variables on the stack (see regalloc.py)
+    state = parse(code, cache=cache, registers="--registers" in argv)
+    if cache is not None:
+        print(cache.stats())
 #print(list(code))
 from vm import run, annotated, d, s, STATUS, MEMORY, VOLRETURN
 #print(len(state)*32, "bytes")
 # Run state
 from vmutils import minify
-minify(state)
+if not argv[1].endswith(".img"):
+    minify(state)
+
+# Runs headless unless a tracer is requested
+tracer = None
+if "--plot" in argv:
+    from tracing import PlotTracer
+    tracer = PlotTracer()
+elif "--csv" in argv:
+    from tracing import CSVTracer
+    tracer = CSVTracer(argv[argv.index("--csv")+1])
+
+# --run-cache <dir> reuses the final states of runs seen before (see runcache.py)
+runcache = None
+if "--run-cache" in argv:
+    from runcache import RunCache
+    runcache = RunCache(path=argv[argv.index("--run-cache")+1])
+
+def saveimage(state):
+    """Writes the final state for --save <file>"""
+    if "--save" in argv:
+        from image import save
+        save(argv[argv.index("--save")+1], state)
+
 print(state)
 while True:
     state = d(state)
@@ -24,7 +60,7 @@ while True:
     print(state)
     state = s(state)
 
-    state = run(state, 10000, 1000000, debug=False)
+    state = run(state, 10000, 1000000, debug=False, tracer=tracer, cache=runcache)
 
     state = d(state)
     if state[STATUS] == VOLRETURN:
@@ -37,8 +73,14 @@ while True:
     else:
         print(state[MEMORY])
         print("NORETURN")
+        if runcache is not None:
+            print(runcache.stats())
+        saveimage(s(state))
         exit(1)
 #print(d(state))
+if tracer is not None:
+    tracer.close()
+saveimage(state)
 
 print(annotated(d(state)))
 
@@ -0,0 +1,105 @@
+"""Final states of runs, keyed by their start state.
+
+Execution is deterministic: a flat state with its STATUS, GAS and MEM set by
+vm.run or RUN always ends in the same final state. A run cache remembers the
+final state for the SHA256 of the start state, with the gas and mem the run
+charged every process above it.
+
+vm.run returns a cached final state without running, and RUN in the
+dispatch engine finishes with a cached child run in one step, charging that
+gas and mem to every process in the chain. It only does so if none of them
+could have run out in between: GAS above the gas (or negative) and MEM at
+least the mem. Otherwise, and the first time, the child runs and its final
+state is remembered.
+
+    cache = RunCache(size=1024, path=".etruns")
+    final = run(state, gas, mem, cache=cache)
+    print(cache.stats())
+
+The cache keeps the `size` most recently used runs in memory. With a path,
+every run is also written there as a JSON file and read back on a miss."""
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+class RunCache:
+    """Final states of runs with the gas and mem they charged, see key"""
+
+    def __init__(self, size=1024, path=None):
+        self.runs = OrderedDict()
+        self.size = size
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, flat):
+        """Key of a run starting in a flat state, which iterates over its words"""
+        return hashlib.sha256(",".join(map(str, flat)).encode()).hexdigest()
+
+    def get(self, key):
+        """[final flat state, gas, mem] of a run, None if it is not cached.
+        mem is None for runs of vm.run, which does not measure it"""
+        found = self.runs.get(key)
+        if found is None and self.path is not None:
+            try:
+                with open(os.path.join(self.path, key + ".json")) as f:
+                    found = json.load(f)
+            except (OSError, ValueError):
+                pass
+            else:
+                self.remember(key, found)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.runs.move_to_end(key)
+        return found
+
+    def put(self, key, final, gas, mem=None):
+        found = [list(final), gas, mem]
+        self.remember(key, found)
+        if self.path is not None:
+            path = os.path.join(self.path, key + ".json")
+            temp = "%s.%i.tmp" % (path, os.getpid())
+            with open(temp, "w") as f:
+                json.dump(found, f)
+            os.replace(temp, path)
+
+    def remember(self, key, found):
+        self.runs[key] = found
+        self.runs.move_to_end(key)
+        if len(self.runs) > self.size:
+            self.runs.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "run cache: %i hits, %i misses (%.0f%% hit rate), %i runs in memory" % (self.hits, self.misses, 100 * self.hits / total if total else 0, len(self.runs))
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from vm import run, s, STATI, STATUS
+    from assembler import translate
+
+    # Usage: python runcache.py [runs] [iterations]
+    # Times a parent that runs the same child `runs` times, with and without a
+    # run cache. The child counts down from `iterations` and returns
+    args = sys.argv[1:]
+    runs = int(args[0]) if len(args) > 0 else 100
+    iterations = int(args[1]) if len(args) > 1 else 1000
+    child = translate("PUSH %i\nloop:\nPUSH 1\nSUB\nDUP\nJZ end\nJUMP loop\nend:\nPOP\nRETURN\n" % iterations)
+    code = translate("PUSH 1\nPUSH 1000000000\nPUSH 1000000000\nRUN\n" * runs + "HALT\n")
+    parent = s([0, 0, 0, 0, 0, code, [], [], [[], s([0, 0, 0, 0, 0, child, [], [], []])]])
+
+    cache = RunCache()
+    finals = []
+    for name, kwargs in [("without cache", {}), ("with cache", {"cache": cache}), ("cached", {"cache": cache})]:
+        start = time.perf_counter()
+        finals.append(run(list(parent), -1, 10**15, **kwargs))
+        print("%s\t%s\t%.4fs" % (name, STATI[finals[-1][STATUS]], time.perf_counter() - start))
+    assert finals[0] == finals[1] == finals[2], "final states differ"
+    print(cache.stats())
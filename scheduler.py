@@ -0,0 +1,133 @@
+"""Runs many independent flat states on a pool of worker processes.
+
+Execution is deterministic and a flat state is self-contained, so any worker
+can run any state. States are time sliced by gas: a worker runs a state until
+its top process has used `quantum` gas (see timeslice) and sends it back
+FROZEN, GAS and MEM as they are. The scheduler queues it again behind the
+others and the next worker resumes it as NORMAL. Results come back as the
+states stop, with any other status. A state that yields (VOLRETURN) has
+stopped too, submit it again to resume it.
+
+    with Scheduler(workers=4, quantum=10000) as scheduler:
+        for state in states:
+            scheduler.submit(state, gas=100000, mem=10**7)
+        for job, final in scheduler.results():
+            print(job, STATI[final[STATUS]], scheduler.steps[job])
+
+Every slice sends the state to a worker and back, so the quantum should be
+large compared to the size of the states.
+
+Usage: python scheduler.py [--quantum n] [--workers n] [--gas n] [--mem n] [<file or directory>...]"""
+
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from vm import REQS, load, dump, dispatch, STATUS, STATI, NORMAL, RECURSE, FROZEN, GAS, MEM
+
+# Most gas a step charges a process, instructions with gas per word can charge more
+MAXGAS = max(req[4] for req in REQS if not req[5])
+
+def advance(states, quantum, engine=dispatch):
+    """Runs a resident process chain until its top process stops or has used
+    at least quantum gas, returns the number of steps"""
+    top = states[0][0]
+    start = top[GAS]
+    count = 0
+    while top[STATUS] in [NORMAL, RECURSE] and start - top[GAS] < quantum:
+        count += engine(states, max(1, (quantum - (start - top[GAS])) // MAXGAS))
+    return count
+
+def timeslice(state, quantum, engine=dispatch):
+    """Runs a flat state until its top process stops or has used at least
+    quantum gas. Returns the flat state, FROZEN if it could go on, and the
+    number of steps"""
+    state = list(state)
+    state[STATUS] = NORMAL
+    states = load(state)
+    count = advance(states, quantum, engine)
+    final = dump(states)
+    if final[STATUS] in [NORMAL, RECURSE]:
+        final[STATUS] = FROZEN
+    return final, count
+
+class Scheduler:
+    """Runs submitted states in time slices on a process pool"""
+
+    def __init__(self, workers=None, quantum=10000):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(self.workers)
+        self.quantum = quantum
+        # Jobs and their FROZEN states, in the order they run next
+        self.waiting = deque()
+        self.running = {}
+        self.steps = []
+
+    def submit(self, state, gas=100, mem=100):
+        """Queues a flat state to run with gas and mem, returns its job number"""
+        state = list(state)
+        state[STATUS] = FROZEN
+        state[GAS] = gas
+        state[MEM] = mem
+        job = len(self.steps)
+        self.steps.append(0)
+        self.waiting.append((job, state))
+        return job
+
+    def results(self):
+        """Yields (job, final flat state) as the states stop, until all have.
+        If the VM raises, the exception takes the place of the state"""
+        while self.waiting or self.running:
+            # One slice per worker, so the queue decides what runs next
+            while self.waiting and len(self.running) < self.workers:
+                job, state = self.waiting.popleft()
+                self.running[self.pool.submit(timeslice, state, self.quantum)] = job
+            done, pending = wait(self.running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = self.running.pop(future)
+                try:
+                    final, count = future.result()
+                except Exception as e:
+                    yield job, e
+                    continue
+                self.steps[job] += count
+                if final[STATUS] == FROZEN:
+                    self.waiting.append((job, final))
+                else:
+                    yield job, final
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    from difftest import compilefile, paths
+    args = sys.argv[1:]
+    options = {"--quantum": 10000, "--workers": None, "--gas": 100000, "--mem": 10**7}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            options[name] = int(args[i+1])
+            del args[i:i+2]
+
+    files = []
+    with Scheduler(options["--workers"], options["--quantum"]) as scheduler:
+        for path in paths(args or ["et"]):
+            try:
+                state = compilefile(path)
+            except Exception as e:
+                print("%s\tdoes not compile: %s" % (path, type(e).__name__))
+                continue
+            files.append(path)
+            scheduler.submit(state, options["--gas"], options["--mem"])
+        for job, final in scheduler.results():
+            if isinstance(final, Exception):
+                print("%s\t%s: %s" % (files[job], type(final).__name__, final))
+                continue
+            print("%s\t%s\t%i steps\tgas %i\tmem %i" % (files[job], STATI[final[STATUS]], scheduler.steps[job], options["--gas"] - final[GAS], options["--mem"] - final[MEM]))
@@ -0,0 +1,128 @@
+"""Interactive processes as asyncio tasks.
+
+A Session runs a process the way run.py does, without blocking the event
+loop: input is appended to its memory as a new area, and when it yields
+(VOLRETURN, see parser's yield_stmt) the last area is popped as its output.
+The process stays resident between inputs and runs in slices of `quantum`
+gas (see scheduler.advance), so one thread can serve many sessions.
+
+    session = Session(state, gas=10000, mem=1000000)
+    task = asyncio.create_task(session.run())
+    await session.send([5])
+    print(await session.receive())      # None once the process has stopped
+
+If the process raises, receive() raises the same exception and run() ends.
+
+Every input gets a fresh budget of gas and mem, like run.py.
+
+Usage: python session.py <file.et or .as> [--sessions n] [--rounds n]
+    runs n sessions at once, sending each of them its number every round"""
+
+import sys
+import time
+import asyncio
+
+from vm import load, flush, ownmemory, adopt, STATUS, NORMAL, RECURSE, GAS, MEM, MEMORY, VOLRETURN
+from scheduler import advance
+
+class Session:
+    """A resident process that takes input from send() and gives output to receive()"""
+
+    def __init__(self, state, gas=10000, mem=1000000, quantum=1000):
+        self.states = load(list(state))
+        self.gas = gas
+        self.mem = mem
+        self.quantum = quantum
+        self.inbox = asyncio.Queue()
+        self.outbox = asyncio.Queue()
+        self.steps = 0
+
+    @property
+    def status(self):
+        return self.states[0][0][STATUS]
+
+    async def send(self, values):
+        """Queues a list of values as the next input"""
+        await self.inbox.put(list(values))
+
+    async def receive(self):
+        """The next output as a list, None if the process stopped instead.
+        Raises the exception the process raised, if any"""
+        output = await self.outbox.get()
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    async def run(self):
+        """Runs the process on every input until it stops without yielding,
+        returns its final status. An exception is passed on to receive()"""
+        process = self.states[0]
+        state = process[0]
+        while True:
+            values = await self.inbox.get()
+            ownmemory(process).append(adopt(process, values))
+            process[2] += 1 + len(values)
+            state[STATUS] = NORMAL
+            state[GAS] = self.gas
+            state[MEM] = self.mem
+            try:
+                while True:
+                    self.steps += advance(self.states, self.quantum)
+                    if state[STATUS] not in [NORMAL, RECURSE]:
+                        break
+                    # Lets the other sessions run
+                    await asyncio.sleep(0)
+            except Exception as e:
+                # Otherwise receive() would wait forever
+                await self.outbox.put(e)
+                raise
+            flush(self.states)
+            if state[STATUS] != VOLRETURN:
+                await self.outbox.put(None)
+                return state[STATUS]
+            output = None
+            if len(state[MEMORY]) > 1:
+                output = ownmemory(process).pop()
+                process[2] -= 1 + len(output)
+            await self.outbox.put(list(output) if output is not None else [])
+
+async def converse(session, inputs):
+    """Sends every input and collects the outputs, until the process stops.
+    Raises if the process does"""
+    outputs = []
+    for values in inputs:
+        await session.send(values)
+        output = await session.receive()
+        if output is None:
+            break
+        outputs.append(output)
+    return outputs
+
+async def main(state, sessions, rounds):
+    everyone = [Session(state) for i in range(sessions)]
+    tasks = [asyncio.create_task(session.run()) for session in everyone]
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*[converse(session, [[i]] * rounds) for i, session in enumerate(everyone)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for task in tasks:
+        task.cancel()
+    # The exceptions were already returned by converse
+    await asyncio.gather(*tasks, return_exceptions=True)
+    failed = [(i, output) for i, output in enumerate(outputs) if isinstance(output, Exception)]
+    for i, e in failed:
+        print("session %i failed: %r" % (i, e))
+        outputs[i] = []
+    print("session 0:", outputs[0])
+    print("session %i: %s" % (sessions - 1, outputs[-1]))
+    print("%i sessions, %i failed, %i outputs, %i steps in %.2fs" % (sessions, len(failed), sum(map(len, outputs)), sum(session.steps for session in everyone), elapsed))
+
+if __name__ == "__main__":
+    from difftest import compilefile
+    args = sys.argv[1:]
+    options = {"--sessions": 100, "--rounds": 10}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            options[name] = int(args[i+1])
+            del args[i:i+2]
+    asyncio.run(main(compilefile(args[0]), options["--sessions"], options["--rounds"]))
@@ -0,0 +1,56 @@
+"""Checks that sessions keep running when one of them fails.
+
+Usage: python sessiontest.py [--sessions n] [--rounds n]
+
+Every session divides 100 by its input and yields the input back. Session 0
+is sent 0, so its process raises ZeroDivisionError. That session must raise
+it from receive(), and all the others must still get all their outputs."""
+
+import sys
+import asyncio
+
+from vm import s
+from assembler import translate
+from session import Session, converse
+
+DIVIDE = """
+start:
+	memorylen
+	push 1
+	sub
+	push 0
+	read
+	push 100
+	flip
+	div
+	pop
+	yield
+	push start
+	jump
+"""
+
+async def check(sessions, rounds):
+    state = s([0, 0, 0, 0, 0, translate(DIVIDE), [], [], [[]]])
+    everyone = [Session(state) for i in range(sessions)]
+    tasks = [asyncio.create_task(session.run()) for session in everyone]
+    # A hanging session fails the check instead of blocking it
+    outputs = await asyncio.wait_for(asyncio.gather(*[converse(session, [[i]] * rounds) for i, session in enumerate(everyone)], return_exceptions=True), 10)
+    # The others wait for more input
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert isinstance(outputs[0], ZeroDivisionError), "session 0 gives %r" % (outputs[0],)
+    assert isinstance(results[0], ZeroDivisionError), "session 0 ends with %r" % (results[0],)
+    for i in range(1, sessions):
+        assert outputs[i] == [[i]] * rounds, "session %i gives %r" % (i, outputs[i])
+    print("ok\t%i sessions, session 0 failed, %i outputs" % (sessions, sum(len(output) for output in outputs[1:])))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"--sessions": 10, "--rounds": 5}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            options[name] = int(args[i+1])
+            del args[i:i+2]
+    asyncio.run(check(options["--sessions"], options["--rounds"]))
@@ -0,0 +1,114 @@
+"""Observers for vm.run. They are called with the step count and the resident
+process chain every `sample` steps, so the run loop itself stays headless.
+GUI libraries are only imported when a visual tracer is created."""
+
+from collections import deque
+
+from vm import GAS, MEM, chainlen, dump
+
+def sample(count, states):
+    """Step, state size (words), then gas and mem of every process in the chain"""
+    row = [count, chainlen(states)]
+    for entry in states:
+        row += [entry[0][GAS], entry[0][MEM]]
+    return row
+
+class Tracer:
+    """Does nothing, base class for all tracers"""
+
+    def trace(self, count, states):
+        pass
+
+    def close(self):
+        pass
+
+class RingTracer(Tracer):
+    """Keeps the last `size` samples in memory"""
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+
+    def trace(self, count, states):
+        self.samples.append(sample(count, states))
+
+class CSVTracer(Tracer):
+    """Writes one line per sample to a file"""
+
+    def __init__(self, path):
+        self.f = open(path, "w")
+
+    def trace(self, count, states):
+        self.f.write(";".join(map(str, sample(count, states))) + "\n")
+
+    def close(self):
+        self.f.close()
+
+class PlotTracer(Tracer):
+    """Live plot of memsec, gas and state size of the top level process"""
+
+    def __init__(self):
+        import matplotlib.pyplot as plt
+        self.plt = plt
+        self.stats = [[] for i in range(4)]
+
+        self.fig, ax1 = plt.subplots()
+        ax1.set_xlabel('step (c)')
+        self.axes = [ax1]
+        for i in range(2):
+            self.axes.append(self.axes[-1].twinx())
+
+        labels = ["memsec", "gas", "statesize (words)"]
+        colors = ["tab:red", "tab:blue", "tab:grey"]
+
+        for i,ax in enumerate(self.axes):
+            ax.plot([], [], color=colors[i])
+            ax.set_ylabel(labels[i], color=colors[i])
+
+        plt.pause(0.0001)
+
+    def trace(self, count, states):
+        self.stats[0].append(count)
+        self.stats[1].append(states[0][0][MEM])
+        self.stats[2].append(states[0][0][GAS])
+        self.stats[3].append(chainlen(states))
+        for i in range(1,4):
+            ax = self.axes[i-1]
+            ax.lines[0].set_xdata(self.stats[0])
+            ax.lines[0].set_ydata(self.stats[i])
+
+            ax.relim()
+            ax.autoscale_view()
+        self.fig.canvas.draw()
+
+    def close(self):
+        self.plt.close(self.fig)
+
+class ImageTracer(Tracer):
+    """Shows the flat state as an image in a Tk window"""
+
+    SIZE = 32
+    SCALE = 8
+
+    def __init__(self):
+        import tkinter as tk
+        from PIL import ImageTk, Image
+        self.ImageTk = ImageTk
+        self.Image = Image
+        self.root = tk.Tk()
+        self.panel = tk.Label(self.root)
+        self.panel.pack(side="bottom", fill="both", expand="yes")
+
+    def trace(self, count, states):
+        SIZE = self.SIZE
+        img = self.Image.new("RGB", (SIZE,SIZE))
+        for i,v in enumerate(dump(states)[:SIZE*SIZE]):
+            img.putpixel((int(i%SIZE), int(i/SIZE)), int(v%256)<<20)
+        img = img.resize((SIZE*self.SCALE, SIZE*self.SCALE))
+
+        img2 = self.ImageTk.PhotoImage(img)
+        self.panel.configure(image=img2)
+        self.panel.image = img2
+        self.root.update()
+
+    def close(self):
+        self.root.destroy()
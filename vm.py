@@ -3,8 +3,11 @@ BYTESIZE = 32
 WORDSIZE = 8*BYTESIZE
 WMAX = 2**WORDSIZE
 WMASK = WMAX-1
+# Words of a public key and of a signature (NIST256p, see crypto.verifywords)
+ECWORDS = 64 // BYTESIZE
 
-from crypto import wrapint, hashit, tob, fromb, genkey, verify
+from crypto import hashint, hashwords, tob, fromb, genkey, verify, verifywords
+from words import Words
 
 STATUS, REC, GAS, MEM, IP, CODE, STACK, MAP, MEMORY = range(9)
 F_STATUS, F_REC, F_GAS, F_MEM, F_IP, F_LENCODE, F_LENSTACK, F_LENMAP, F_LENMEMORY, F_CODE, F_STACK, F_MAP, F_MEMORY = range(13)
@@ -12,49 +15,60 @@ F_STATUS, F_REC, F_GAS, F_MEM, F_IP, F_LENCODE, F_LENSTACK, F_LENMAP, F_LENMEMOR
 NORMAL, FROZEN, VOLHALT, VOLRETURN, OOG, OOC, OOS, OOM, OOB, UOC, RECURSE = range(11)
 STATI = ["NORMAL", "FROZEN", "VOLHALT", "VOLRETURN", "OUTOFGAS", "OUTOFCODE", "OUTOFSTACK", "OUTOFMEMORY", "OUTOFBOUNDS", "UNKNOWNCODE", "RUN"]
 
-HALT, RETURN, YIELD, RUN, JUMP, JZ, PUSH, POP, DUP, FLIP, KEYSET, KEYHAS, KEYGET, KEYDEL, STACKLEN, MEMORYLEN, AREALEN, READ, WRITE, AREA, DEAREA, ALLOC, DEALLOC, ADD, SUB, NOT, MUL, DIV, MOD, SHA256, ECVERIFY = range(31)
+HALT, RETURN, YIELD, RUN, JUMP, JZ, PUSH, POP, DUP, FLIP, KEYSET, KEYHAS, KEYGET, KEYDEL, STACKLEN, MEMORYLEN, AREALEN, READ, WRITE, AREA, DEAREA, ALLOC, DEALLOC, ADD, SUB, NOT, MUL, DIV, MOD, SHA256, ECVERIFY, MEMCPY, MEMSET, MEMCMP, MEMHASH = range(35)
 
 REQS = [
-    # Name, Instruction length, Required Stack Size, Stack effect, Gas cost
-    ["HALT",1,0,0,1],
-    ["RETURN",1,0,0,1],
-    ["YIELD",1,0,0,1],
-
-    ["RUN",1,3,-3,0],
-
-    ["JUMP",1,1,-1,1],
-    ["JZ",1,2,-2,1],
-
-    ["PUSH",2,0,1,2],
-    ["POP",1,0,0,2],
-    ["DUP",1,0,1,4],
-    ["FLIP",1,2,0,4],
-
-    ["KEYSET",1,2,-2,10],
-    ["KEYHAS",1,1,0,4],
-    ["KEYGET",1,1,0,6],
-    ["KEYDEL",1,1,-1,4],
-
-    ["STACKLEN",1,0,1,2],
-    ["MEMORYLEN",1,0,1,2],
-    ["AREALEN",1,1,0,2],
-
-    ["READ",1,2,-1,2],
-    ["WRITE",1,3,-3,2],
-
-    ["AREA",1,0,1,10],
-    ["DEAREA",1,1,-1,10],#!use after free!
-    ["ALLOC",1,2,-2,10],
-    ["DEALLOC",1,2,-2,10],
-
-    ["ADD",1,2,-1,6],
-    ["SUB",1,2,-1,6],
-    ["NOT",1,1,0,4],
-    ["MUL",1,2,-1,8],
-    ["DIV",1,2,-1,10],
-    ["MOD",1,2,-1,10],
-
-    ["SHA256",1,1,0,100],
+    # Name, Instruction length, Required Stack Size, Stack effect, Gas cost,
+    # Gas per word of the length on top of the stack (bulk memory instructions)
+    ["HALT",1,0,0,1,0],
+    ["RETURN",1,0,0,1,0],
+    ["YIELD",1,0,0,1,0],
+
+    ["RUN",1,3,-3,0,0],
+
+    ["JUMP",1,1,-1,1,0],
+    ["JZ",1,2,-2,1,0],
+
+    ["PUSH",2,0,1,2,0],
+    ["POP",1,0,0,2,0],
+    ["DUP",1,0,1,4,0],
+    ["FLIP",1,2,0,4,0],
+
+    ["KEYSET",1,2,-2,10,0],
+    ["KEYHAS",1,1,0,4,0],
+    ["KEYGET",1,1,0,6,0],
+    ["KEYDEL",1,1,-1,4,0],
+
+    ["STACKLEN",1,0,1,2,0],
+    ["MEMORYLEN",1,0,1,2,0],
+    ["AREALEN",1,1,0,2,0],
+
+    ["READ",1,2,-1,2,0],
+    ["WRITE",1,3,-3,2,0],
+
+    ["AREA",1,0,1,10,0],
+    ["DEAREA",1,1,-1,10,0],#!use after free!
+    ["ALLOC",1,2,-2,10,0],
+    ["DEALLOC",1,2,-2,10,0],
+
+    ["ADD",1,2,-1,6,0],
+    ["SUB",1,2,-1,6,0],
+    ["NOT",1,1,0,4,0],
+    ["MUL",1,2,-1,8,0],
+    ["DIV",1,2,-1,10,0],
+    ["MOD",1,2,-1,10,0],
+
+    ["SHA256",1,1,0,100,0],
+
+    # Key area, key addr, signature area, signature addr, message area,
+    # message addr, message length. 1 if the signature is valid, else 0
+    ["ECVERIFY",1,7,-6,1000,4],
+
+    # Copy, fill, compare and hash ranges of memory areas
+    ["MEMCPY",1,5,-5,10,1],
+    ["MEMSET",1,4,-4,10,1],
+    ["MEMCMP",1,5,-4,10,1],
+    ["MEMHASH",1,3,-2,100,4],
 ]
 
 def s(state):
@@ -66,10 +80,13 @@ def s(state):
     flat += [len(state[MEMORY])]
     flat += state[CODE]
     flat += state[STACK]
-    for i in range(0, len(state[MAP]), 2):
-        k = state[MAP][i]
-        v = state[MAP][i+1]
-        flat += [k, v]
+    if isinstance(state[MAP], Map):
+        flat += state[MAP]
+    else:
+        for i in range(0, len(state[MAP]), 2):
+            k = state[MAP][i]
+            v = state[MAP][i+1]
+            flat += [k, v]
     for area in state[MEMORY]:
         flat += [len(area)]
         flat += area
@@ -98,6 +115,122 @@ def d(state):
         index = index + 1 + lenarea
     return sharp
 
+HOLE = object()
+# Returned by Map.get for keys that are not set, a value may be None
+MISSING = object()
+
+class Map:
+    """Indexed version of the flat [k, v, k, v, ...] map, used by resident states.
+
+    Keeps insertion order in slots and a dict from key to the slot of its first
+    occurrence, iterates and measures like the flat list so s() is unchanged.
+    Maps of odd length (malformed) are kept as a list and scanned linearly."""
+
+    def __init__(self, flat):
+        self.linear = None
+        if len(flat) % 2:
+            self.linear = flat
+            return
+        self.keys = flat[0::2]
+        self.values = flat[1::2]
+        self.live = len(self.keys)
+        self.dups = False
+        self.index = {}
+        for slot in range(len(self.keys)-1, -1, -1):
+            if self.keys[slot] in self.index:
+                self.dups = True
+            self.index[self.keys[slot]] = slot
+
+    def __len__(self):
+        if self.linear is not None:
+            return len(self.linear)
+        return 2 * self.live
+
+    def __iter__(self):
+        if self.linear is not None:
+            for i in range(0, len(self.linear), 2):
+                yield self.linear[i]
+                yield self.linear[i+1]
+            return
+        for slot, k in enumerate(self.keys):
+            if k is not HOLE:
+                yield k
+                yield self.values[slot]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def has(self, key):
+        if self.linear is not None:
+            return key in self.linear[0::2]
+        return key in self.index
+
+    def get(self, key):
+        """Returns the value of key, MISSING if it is not set"""
+        if self.linear is not None:
+            for i in range(0, len(self.linear), 2):
+                if self.linear[i] == key:
+                    return self.linear[i+1]
+            return MISSING
+        slot = self.index.get(key)
+        if slot is None:
+            return MISSING
+        return self.values[slot]
+
+    def set(self, key, value):
+        """Sets key to value, returns whether a new entry was added"""
+        if self.linear is not None:
+            for i in range(0, len(self.linear), 2):
+                if self.linear[i] == key:
+                    self.linear[i+1] = value
+                    return False
+            self.linear += [key, value]
+            return True
+        slot = self.index.get(key)
+        if slot is not None:
+            self.values[slot] = value
+            return False
+        self.index[key] = len(self.keys)
+        self.keys.append(key)
+        self.values.append(value)
+        self.live += 1
+        return True
+
+    def delete(self, key):
+        """Removes the first entry of key, returns whether there was one"""
+        if self.linear is not None:
+            for i in range(0, len(self.linear), 2):
+                if self.linear[i] == key:
+                    self.linear.pop(i)
+                    self.linear.pop(i)
+                    return True
+            return False
+        slot = self.index.pop(key, None)
+        if slot is None:
+            return False
+        self.keys[slot] = HOLE
+        self.values[slot] = None
+        self.live -= 1
+        if self.dups:
+            for later in range(slot+1, len(self.keys)):
+                if self.keys[later] == key:
+                    self.index[key] = later
+                    break
+        if len(self.keys) > 2 * self.live + 8:
+            self.__init__(list(self))
+        return True
+
+    def copy(self):
+        if self.linear is not None:
+            return Map(list(self.linear))
+        return Map(list(self))
+
+def resident(state):
+    """Deserializes a flat state for resident execution"""
+    state = d(state)
+    state[MAP] = Map(state[MAP])
+    return state
+
 from utils import odict
 
 def annotated(d):
@@ -109,15 +242,243 @@ def annotated(d):
         "memory": d[LENMEMORY+4],
     ]
 
+class Child:
+    """A child process left resident in its parent's memory area after RUN.
+
+    Measures and iterates like its flat serialization, so s(), AREALEN and
+    READ work on it without converting. Entering and leaving it is O(1),
+    instructions that modify the area flatten it first (see flatarea)."""
+
+    def __init__(self, process, counted):
+        self.process = process
+        # Length of the area as accounted for in the parent's memlen
+        self.counted = counted
+
+    def __len__(self):
+        return flatlen(self.process)
+
+    def __iter__(self):
+        return iter(s(self.process[0]))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __getitem__(self, addr):
+        if addr < 0:
+            addr += len(self)
+        if addr < 0:
+            raise IndexError("area index out of range")
+        state = self.process[0]
+        if addr < F_CODE:
+            return (state[:CODE] + [len(state[CODE]), len(state[STACK]), len(state[MAP]), len(state[MEMORY])])[addr]
+        addr -= F_CODE
+        for section in state[CODE], state[STACK]:
+            if addr < len(section):
+                return section[addr]
+            addr -= len(section)
+        if addr < len(state[MAP]):
+            return list(state[MAP])[addr]
+        addr -= len(state[MAP])
+        for area in state[MEMORY]:
+            if addr == 0:
+                return len(area)
+            if addr <= len(area):
+                return area[addr-1]
+            addr -= 1 + len(area)
+        raise IndexError("area index out of range")
+
+def owns(process, obj):
+    """Whether a resident process may change obj, or has to copy it because it
+    shares it with a snapshot"""
+    return process[5] is None or id(obj) in process[5]
+
+def adopt(process, obj):
+    """Marks obj, created by a resident process, as owned by it"""
+    if process[5] is not None:
+        process[5].add(id(obj))
+    return obj
+
+def ownmemory(process):
+    """The MEMORY list of a resident process, copied first if it is shared"""
+    state = process[0]
+    if not owns(process, state[MEMORY]):
+        state[MEMORY] = adopt(process, list(state[MEMORY]))
+    return state[MEMORY]
+
+def ownmap(process):
+    """The MAP of a resident process, copied first if it is shared"""
+    state = process[0]
+    if not owns(process, state[MAP]):
+        state[MAP] = adopt(process, state[MAP].copy())
+    return state[MAP]
+
+def flatarea(process, area):
+    """Returns a memory area of a resident process as a list it may change.
+    Flattens a resident child or an image area (see image.py) kept there and
+    copies areas shared with a snapshot"""
+    words = process[0][MEMORY][area]
+    if not isinstance(words, list) or not owns(process, words):
+        words = list(words)
+        ownmemory(process)[area] = adopt(process, words)
+    return words
+
+def cost(reqs, stack):
+    """Gas an instruction costs. Bulk memory instructions also pay for every
+    word of the length on top of the stack"""
+    if reqs[5]:
+        return reqs[4] + reqs[5] * max(0, stack[-1])
+    return reqs[4]
+
+def validrange(memory, area, addr, length):
+    """Whether `length` words from addr on exist in a memory area"""
+    return 0 <= area < len(memory) and 0 <= addr and 0 <= length and addr + length <= len(memory[area])
+
+def span(words, start, end):
+    """words[start:end] of a memory area, which may hold a resident child"""
+    if isinstance(words, Child):
+        words = list(words)
+    return words[start:end]
+
+def difference(first, second):
+    """0 if two ranges of words are equal, else 1 + the offset of the first
+    word that differs"""
+    if first == second:
+        return 0
+    for i, (a, b) in enumerate(zip(first, second)):
+        if a != b:
+            return i + 1
+
+def ownchild(process, area):
+    """The Child in a memory area of a resident process, forked first if it is shared"""
+    child = process[0][MEMORY][area]
+    if not owns(process, child):
+        child = Child(fork(child.process), child.counted)
+        ownmemory(process)[area] = adopt(process, child)
+    return child
+
+def childstate(process, area):
+    """The (flat or resident) state of the child process in a memory area"""
+    if isinstance(process[0][MEMORY][area], Child):
+        return ownchild(process, area).process[0]
+    return flatarea(process, area)
+
+def memlen(state):
+    """Number of words the memory areas take up in s(state)"""
+    return len(state[MEMORY]) + sum(len(area) for area in state[MEMORY])
+
+def entry(state, area=None):
+    """Resident chain entry: State, ADDR, memlen(State), decoded CODE and its
+    basic blocks (see decode and blocks), the ids of the objects it owns
+    if it shares others with a snapshot (None: owns everything, see fork) and
+    the child run it measures for a run cache (see replay)"""
+    return [state, area, memlen(state), None, None, None, None]
+
+def fork(process):
+    """A resident process sharing CODE, MAP and MEMORY with `process` until it
+    changes them (copy-on-write, see owns). The stack is copied"""
+    state = process[0][:]
+    state[STACK] = list(state[STACK])
+    return [state, process[1], process[2], process[3], process[4], set(), None]
+
+def load(state):
+    """Deserializes a flat state into a resident process chain"""
+    return [entry(resident(state))]
+
+def enter(states, area):
+    """Appends the child process in a memory area of the innermost process to
+    the chain. It stays in the area as a Child, so this is O(1) when re-entered"""
+    process = states[-1]
+    child = process[0][MEMORY][area]
+    if isinstance(child, Child):
+        child = ownchild(process, area)
+    else:
+        child = Child(entry(resident(child)), len(child))
+        ownmemory(process)[area] = adopt(process, child)
+    child.process[1] = area
+    states.append(child.process)
+
+def settle(states, level=0):
+    """Updates the memlen of the processes from `level` on with the sizes of
+    their resident children, which change while they run"""
+    for i in range(len(states)-1, level, -1):
+        child = states[i-1][0][MEMORY][states[i][1]]
+        size = len(child)
+        states[i-1][2] += size - child.counted
+        child.counted = size
+
+def flush(states, level=0):
+    """Leaves resident children below `level`, they remain in their parents'
+    memory areas"""
+    settle(states, level)
+    del states[level+1:]
+
+def dump(states):
+    """Serializes a resident process chain without leaving resident mode"""
+    settle(states)
+    return s(states[0][0])
+
+def flatlen(process):
+    """Length of s(state) for a resident chain entry, without serializing it"""
+    state = process[0]
+    return F_CODE + len(state[CODE]) + len(state[STACK]) + len(state[MAP]) + process[2]
+
+def chainlen(states):
+    """Length of dump(states), without serializing it"""
+    settle(states)
+    return flatlen(states[0])
+
+class Snapshot:
+    """A frozen resident process chain, see snapshot and rollback"""
+
+    def __init__(self, process, areas):
+        self.process = process
+        self.areas = areas
+
+    def flat(self):
+        """The flat state at the time of the snapshot"""
+        return s(self.process[0])
+
+def snapshot(states):
+    """Takes a snapshot of a resident process chain. The chain continues on
+    copy-on-write forks, so only the header and stack of every process and the
+    MEMORY list of every parent in the chain are copied"""
+    settle(states)
+    frozen = fork(states[0])
+    states[0][5] = set()
+    for i in range(1, len(states)):
+        states[i] = ownchild(states[i-1], states[i][1]).process
+    return Snapshot(frozen, [process[1] for process in states[1:]])
+
+def rollback(states, snapshot):
+    """Restores a resident process chain to a snapshot, in place. The snapshot
+    stays valid, areas are only copied when they are changed again"""
+    chain = [fork(snapshot.process)]
+    for area in snapshot.areas:
+        chain.append(ownchild(chain[-1], area).process)
+    states[:] = chain
+
 def step(state):
-    """Stateless step function. Maps states to states."""
+    """Stateless step function. Maps states to states, Words to Words."""
+    states = load(state)
+    advance(states)
+    flush(states)
+    flat = s(states[0][0])
+    if isinstance(state, Words):
+        return Words(flat)
+    return flat
+
+def advance(states):
+    """Executes a single step on a resident process chain.
+
+    Children entered with RUN stay deserialized in the chain between steps,
+    their parents' memory areas are only updated by flush() or dump()."""
 
     def next(jump=None):
         """Pops arguments. Sets the instruction pointer"""
         nonlocal state
 
         if reqs[3] < 0:
-            state[STACK] = state[STACK][:reqs[3]]
+            del state[STACK][reqs[3]:]
             state[MEM] += abs(reqs[3])
 
         if jump is None:
@@ -175,13 +536,10 @@ def step(state):
             state[STATUS] = OOM
             return False
 
-    state = d(state)
-    # State, ADDR
-    states = [[state, None]]
+    level = 0
 
     while True:
-        state = states[-1][0]
-
+        state = states[level][0]
         # Check if state has enough gas
         if state[GAS] == 0:
             state[STATUS] = OOG
@@ -210,6 +568,12 @@ def step(state):
         def checkResources():
             nonlocal states
             error = True
+            if instr != RUN:
+                gascost = cost(reqs, state[STACK])
+                # len(s(state)), kept up to date by the instructions changing memory
+                totalmemoryuse = flatlen(states[level]) * gascost
+            else:
+                totalmemoryuse = 0#not correct, run pops from stack, but not always
             for ps in states:
                 # Check if current instruction has enough memory for stack effects
                 p = ps[0]
@@ -225,11 +589,11 @@ def step(state):
                     else:
                         return 0
                 if instr != RUN:
-                    gascost = reqs[4]
+                    if reqs[5] and 0 <= p[GAS] < gascost:
+                        # Bulk instructions do not skip past 0 gas
+                        p[STATUS] = OOG
+                        break
                     p[GAS] -= gascost # RUN RUN RUN?#only subtract if not OOM down there!
-                    totalmemoryuse = len(s(state)) * gascost#reqs[3] + getMemoryUse(instr)
-                else:
-                    totalmemoryuse = 0#not correct, run pops from stack, but not always
                 if p[MEM] < totalmemoryuse:
                     p[STATUS] = OOM
                     break
@@ -241,8 +605,10 @@ def step(state):
 
         if instr == RUN:
             area, gas, mem = state[STACK][-3:]
+            if len(states) > level + 1 and states[level+1][1] != area:
+                flush(states, level)
             if validarea(area) and len(state[MEMORY][area]) > 4:#HEADERLEN
-                child = state[MEMORY][area]
+                child = childstate(states[level], area)
 
                 if state[REC] == 0:
                     child[STATUS] = NORMAL
@@ -257,11 +623,14 @@ def step(state):
                     #print(">>>")
                     #state[MEMORY][area] = step(state[MEMORY][area])
                     #print(state[MEMORY], area)
-                    states.append([d(state[MEMORY][area]), area])
+                    if len(states) == level + 1:
+                        enter(states, area)
+                    level += 1
                     #print("<<<")
                 else:
                     #child[STATUS] = FROZEN
                     #may not be required
+                    flush(states, level)
                     if checkResources():
                         break
                     state[REC] = 0
@@ -271,8 +640,8 @@ def step(state):
                 next()
         else:
             #print("".join(["<-|%s¦%i¦%i¦%s|" % (STATI[states[i][0][STATUS]], states[i][0][GAS], states[i][0][MEM], REQS[states[i][0][CODE][states[i][0][IP]]][0]) for i in range(len(states))]))
-            #CSV
-            print("".join(["%i;%i" % (states[i][0][GAS], states[i][0][MEM]) for i in range(len(states))]))
+            if len(states) > level + 1:
+                flush(states, level)
             if checkResources():
                 break
 
@@ -297,7 +666,7 @@ def step(state):
                 next()
             elif instr == POP:
                 if len(state[STACK]) > 0:
-                    state[STACK] = state[STACK][:-1]
+                    state[STACK].pop()
                     state[MEM] += 1
                     next()
             elif instr == DUP:
@@ -309,39 +678,23 @@ def step(state):
             elif instr == KEYSET:
 
                 if hasmem(2):#or only exit if memory is actually needed?
-                    kv = [state[STACK][-2], state[STACK][-1]]
-                    for i in range(0, len(state[MAP]), 2):
-                        if state[MAP][i] == kv[0]:
-                            state[MAP][i+1] = kv[1]
-                            break
-                    else:
-                        state[MAP] += kv
+                    if ownmap(states[level]).set(state[STACK][-2], state[STACK][-1]):
                         state[MEM] -= 2
                     next()
             elif instr == KEYHAS:
-                for i in range(0, len(state[MAP]), 2):
-                    if state[MAP][i] == state[STACK][-1]:
-                        state[STACK][-1] = 1
-                        break
-                else:
-                    state[STACK][-1] = 0
+                state[STACK][-1] = 1 if state[MAP].has(state[STACK][-1]) else 0
                 next()
             elif instr == KEYGET:
-                for i in range(0, len(state[MAP]), 2):
-                    if state[MAP][i] == state[STACK][-1]:
-                        state[STACK][-1] = state[MAP][i+1]
-                        break
+                value = state[MAP].get(state[STACK][-1])
+                if value is not MISSING:
+                    state[STACK][-1] = value
                 else:
                     state[STACK].pop(-1)
                     state[MEM] += 1
                 next()
             elif instr == KEYDEL:
-                for i in range(0, len(state[MAP]), 2):
-                    if state[MAP][i] == state[STACK][-1]:
-                        state[MAP].pop(i)
-                        state[MAP].pop(i)
-                        state[MEM] += 2
-                        break
+                if ownmap(states[level]).delete(state[STACK][-1]):
+                    state[MEM] += 2
                 next()
             elif instr == STACKLEN:
                 if push(len(state[STACK])):
@@ -362,17 +715,18 @@ def step(state):
             elif instr == WRITE:
                 area, addr, value = state[STACK][-3:]
                 if validmemory(area, addr):
-                    state[MEMORY][area][addr] = value
+                    flatarea(states[level], area)[addr] = value
                     next()
             elif instr == AREA:
                 # This should cost 1 mem
                 if hasmem(1):
-                    state[MEMORY].append([])
+                    ownmemory(states[level]).append(adopt(states[level], []))
+                    states[level][2] += 1
                     state[MEM] -= 1
                     next()
             elif instr == DEAREA:
                 state[MEM] += len(state[MEMORY][top()])
-                state[MEMORY].pop(top())
+                states[level][2] -= 1 + len(ownmemory(states[level]).pop(top()))
                 next()
             elif instr == ALLOC:
                 area, size = state[STACK][-2:]
@@ -380,14 +734,20 @@ def step(state):
                 if hasmem(size):
                     if validarea(area):
                         state[MEM] -= size
-                        state[MEMORY][area] += [0] * size
+                        states[level][2] -= len(state[MEMORY][area])
+                        flatarea(states[level], area).extend([0] * size)
+                        states[level][2] += len(state[MEMORY][area])
                         next()
             elif instr == DEALLOC:
                 area, size = state[STACK][-2:]
                 if validarea(area):
                     if len(state[MEMORY][area]) >= size:
                         state[MEM] += size
-                        state[MEMORY][area] = state[MEMORY][area][:-size]
+                        # Deallocating 0 words empties the area
+                        states[level][2] -= len(state[MEMORY][area])
+                        words = flatarea(states[level], area)
+                        del words[-size:]
+                        states[level][2] += len(state[MEMORY][area])
                         next()
                     else:
                         state[STATUS] = OOB
@@ -415,109 +775,672 @@ def step(state):
                 state[STACK][-2] = op1 % op2
                 next()
             elif instr == SHA256:
-                state[STACK][-1] = wrapint(state[STACK][-1], hashit)
+                state[STACK][-1] = hashint(state[STACK][-1])
                 next()
             elif instr == ECVERIFY:
-                #if verify(state[STACK][-1], ):
-                pass
+                key, keyaddr, signature, sigaddr, area, addr, length = state[STACK][-7:]
+                if validrange(state[MEMORY], key, keyaddr, ECWORDS) and validrange(state[MEMORY], signature, sigaddr, ECWORDS) and validrange(state[MEMORY], area, addr, length):
+                    state[STACK][-7] = int(verifywords(span(state[MEMORY][key], keyaddr, keyaddr + ECWORDS), span(state[MEMORY][signature], sigaddr, sigaddr + ECWORDS), span(state[MEMORY][area], addr, addr + length)))
+                    next()
+                else:
+                    state[STATUS] = OOB
+            elif instr == MEMCPY:
+                area, addr, source, start, length = state[STACK][-5:]
+                if validrange(state[MEMORY], source, start, length) and validrange(state[MEMORY], area, addr, length):
+                    words = span(state[MEMORY][source], start, start + length)
+                    flatarea(states[level], area)[addr:addr+length] = words
+                    next()
+                else:
+                    state[STATUS] = OOB
+            elif instr == MEMSET:
+                area, addr, value, length = state[STACK][-4:]
+                if validrange(state[MEMORY], area, addr, length):
+                    flatarea(states[level], area)[addr:addr+length] = [value] * length
+                    next()
+                else:
+                    state[STATUS] = OOB
+            elif instr == MEMCMP:
+                area, addr, other, start, length = state[STACK][-5:]
+                if validrange(state[MEMORY], area, addr, length) and validrange(state[MEMORY], other, start, length):
+                    state[STACK][-5] = difference(span(state[MEMORY][area], addr, addr + length), span(state[MEMORY][other], start, start + length))
+                    next()
+                else:
+                    state[STATUS] = OOB
+            elif instr == MEMHASH:
+                area, addr, length = state[STACK][-3:]
+                if validrange(state[MEMORY], area, addr, length):
+                    state[STACK][-3] = hashwords(span(state[MEMORY][area], addr, addr + length))
+                    next()
+                else:
+                    state[STATUS] = OOB
             else:
                 state[STATUS] = UOC
 
             break
 
-    for i, state in enumerate(states[::-1]):
-        if i!=0:
-            state[0][MEMORY][states[-1][1]] = states[-i][0]
-        states[-i-1][0] = s(state[0])
-    return states[0][0]
-
-
-from time import sleep
-
-import tkinter as tk
-from PIL import ImageTk, Image
-
-"""
-root = tk.Tk()
-img = ImageTk.PhotoImage(Image.open("test.png"))
-panel = tk.Label(root, image=img)
-panel.pack(side="bottom", fill="both", expand="yes")
-"""
 
-def show(state):
-    SIZE = 32
-    SCALE = 8
-    img = Image.new("RGB", (SIZE,SIZE))
-    for i,v in enumerate(state):
-        img.putpixel((int(i%SIZE), int(i/SIZE)), int(v%256)<<20)
-    img = img.resize((SIZE*SCALE, SIZE*SCALE))
 
-    img2 = ImageTk.PhotoImage(img)
-    panel.configure(image=img2)
-    panel.image = img2
-    root.update()
-
-numlines = 4
-stats = [[] for i in range(numlines)]
+# Dispatch engine. decode() looks up the handler, operand and REQS entry for
+# every instruction pointer once per resident process, and checks that do not
+# depend on the stack are done there. Handlers run after gas and memory were
+# charged and behave exactly like the matching branch in advance().
+
+def op_halt(process, state, arg):
+    state[STATUS] = VOLHALT
+    state[IP] += 1
+
+def op_return(process, state, arg):
+    state[STATUS] = VOLRETURN
+    state[IP] = 0
+
+def op_yield(process, state, arg):
+    state[STATUS] = VOLRETURN
+    state[IP] += 1
+
+def op_run(process, state, arg):
+    """Marker, RUN changes the process chain and is handled by dispatch()"""
+
+def op_jump(process, state, arg):
+    state[IP] = state[STACK].pop()
+    state[MEM] += 1
+
+def op_jz(process, state, arg):
+    stack = state[STACK]
+    if stack[-2] == 0:
+        state[IP] = stack[-1]
+    else:
+        state[IP] += 1
+    del stack[-2:]
+    state[MEM] += 2
+
+def op_push(process, state, arg):
+    state[STACK].append(arg)
+    state[IP] += 2
+
+def op_pop(process, state, arg):
+    if len(state[STACK]) > 0:
+        state[STACK].pop()
+        state[MEM] += 1
+        state[IP] += 1
+
+def op_dup(process, state, arg):
+    stack = state[STACK]
+    stack.append(stack[-1] if len(stack) > 0 else None)
+    state[IP] += 1
+
+def op_flip(process, state, arg):
+    stack = state[STACK]
+    stack[-2], stack[-1] = stack[-1], stack[-2]
+    state[IP] += 1
+
+def op_keyset(process, state, arg):
+    if state[MEM] < 2:
+        state[STATUS] = OOM
+        return
+    stack = state[STACK]
+    if ownmap(process).set(stack[-2], stack[-1]):
+        state[MEM] -= 2
+    del stack[-2:]
+    state[MEM] += 2
+    state[IP] += 1
+
+def op_keyhas(process, state, arg):
+    stack = state[STACK]
+    stack[-1] = 1 if state[MAP].has(stack[-1]) else 0
+    state[IP] += 1
+
+def op_keyget(process, state, arg):
+    stack = state[STACK]
+    value = state[MAP].get(stack[-1])
+    if value is not MISSING:
+        stack[-1] = value
+    else:
+        stack.pop()
+        state[MEM] += 1
+    state[IP] += 1
+
+def op_keydel(process, state, arg):
+    stack = state[STACK]
+    if ownmap(process).delete(stack[-1]):
+        state[MEM] += 2
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_stacklen(process, state, arg):
+    if state[MEM] == 0:
+        state[STATUS] = OOM
+        return
+    state[STACK].append(len(state[STACK]))
+    state[MEM] -= 1
+    state[IP] += 1
+
+def op_memorylen(process, state, arg):
+    if state[MEM] == 0:
+        state[STATUS] = OOM
+        return
+    state[STACK].append(len(state[MEMORY]))
+    state[MEM] -= 1
+    state[IP] += 1
+
+def op_arealen(process, state, arg):
+    stack = state[STACK]
+    if stack[-1] >= len(state[MEMORY]):
+        state[STATUS] = OOB
+        return
+    stack[-1] = len(state[MEMORY][stack[-1]])
+    state[IP] += 1
+
+def op_read(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, addr = stack[-2:]
+    if area >= len(memory) or addr >= len(memory[area]):
+        state[STATUS] = OOB
+        return
+    stack[-2] = memory[area][addr]
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_write(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, addr, value = stack[-3:]
+    if area >= len(memory) or addr >= len(memory[area]):
+        state[STATUS] = OOB
+        return
+    flatarea(process, area)[addr] = value
+    del stack[-3:]
+    state[MEM] += 3
+    state[IP] += 1
+
+def op_area(process, state, arg):
+    if state[MEM] < 1:
+        state[STATUS] = OOM
+        return
+    ownmemory(process).append(adopt(process, []))
+    process[2] += 1
+    state[MEM] -= 1
+    state[IP] += 1
+
+def op_dearea(process, state, arg):
+    stack = state[STACK]
+    state[MEM] += len(state[MEMORY][stack[-1]])
+    process[2] -= 1 + len(ownmemory(process).pop(stack[-1]))
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_alloc(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, size = stack[-2:]
+    if size > state[MEM]:
+        state[STATUS] = OOM
+        return
+    if area >= len(memory):
+        state[STATUS] = OOB
+        return
+    state[MEM] -= size
+    words = flatarea(process, area)
+    process[2] -= len(words)
+    words.extend([0] * size)
+    process[2] += len(words)
+    del stack[-2:]
+    state[MEM] += 2
+    state[IP] += 1
+
+def op_dealloc(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, size = stack[-2:]
+    if area >= len(memory) or len(memory[area]) < size:
+        state[STATUS] = OOB
+        return
+    state[MEM] += size
+    # Deallocating 0 words empties the area
+    words = flatarea(process, area)
+    process[2] -= len(words)
+    del words[-size:]
+    process[2] += len(words)
+    del stack[-2:]
+    state[MEM] += 2
+    state[IP] += 1
+
+def op_add(process, state, arg):
+    stack = state[STACK]
+    stack[-2] = stack[-2] + stack[-1]
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_sub(process, state, arg):
+    stack = state[STACK]
+    stack[-2] = (stack[-2] - stack[-1]) % WMAX
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_not(process, state, arg):
+    stack = state[STACK]
+    stack[-1] = ~stack[-1] & WMASK
+    state[IP] += 1
+
+def op_mul(process, state, arg):
+    stack = state[STACK]
+    stack[-2] = (stack[-2] * stack[-1]) % WMAX
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_div(process, state, arg):
+    stack = state[STACK]
+    stack[-2] = stack[-2] // stack[-1]
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_mod(process, state, arg):
+    stack = state[STACK]
+    stack[-2] = stack[-2] % stack[-1]
+    stack.pop()
+    state[MEM] += 1
+    state[IP] += 1
+
+def op_sha256(process, state, arg):
+    stack = state[STACK]
+    stack[-1] = hashint(stack[-1])
+    state[IP] += 1
+
+def op_ecverify(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    key, keyaddr, signature, sigaddr, area, addr, length = stack[-7:]
+    if not validrange(memory, key, keyaddr, ECWORDS) or not validrange(memory, signature, sigaddr, ECWORDS) or not validrange(memory, area, addr, length):
+        state[STATUS] = OOB
+        return
+    stack[-7] = int(verifywords(span(memory[key], keyaddr, keyaddr + ECWORDS), span(memory[signature], sigaddr, sigaddr + ECWORDS), span(memory[area], addr, addr + length)))
+    del stack[-6:]
+    state[MEM] += 6
+    state[IP] += 1
+
+def op_memcpy(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, addr, source, start, length = stack[-5:]
+    if not validrange(memory, source, start, length) or not validrange(memory, area, addr, length):
+        state[STATUS] = OOB
+        return
+    flatarea(process, area)[addr:addr+length] = span(memory[source], start, start + length)
+    del stack[-5:]
+    state[MEM] += 5
+    state[IP] += 1
+
+def op_memset(process, state, arg):
+    stack = state[STACK]
+    area, addr, value, length = stack[-4:]
+    if not validrange(state[MEMORY], area, addr, length):
+        state[STATUS] = OOB
+        return
+    flatarea(process, area)[addr:addr+length] = [value] * length
+    del stack[-4:]
+    state[MEM] += 4
+    state[IP] += 1
+
+def op_memcmp(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, addr, other, start, length = stack[-5:]
+    if not validrange(memory, area, addr, length) or not validrange(memory, other, start, length):
+        state[STATUS] = OOB
+        return
+    stack[-5] = difference(span(memory[area], addr, addr + length), span(memory[other], start, start + length))
+    del stack[-4:]
+    state[MEM] += 4
+    state[IP] += 1
+
+def op_memhash(process, state, arg):
+    stack = state[STACK]
+    memory = state[MEMORY]
+    area, addr, length = stack[-3:]
+    if not validrange(memory, area, addr, length):
+        state[STATUS] = OOB
+        return
+    stack[-3] = hashwords(span(memory[area], addr, addr + length))
+    del stack[-2:]
+    state[MEM] += 2
+    state[IP] += 1
+
+def op_unknown(process, state, arg):
+    state[STATUS] = UOC
+
+def op_outofcode(process, state, arg):
+    """Marker for instructions extending past the end of the code"""
+
+HANDLERS = [op_halt, op_return, op_yield, op_run, op_jump, op_jz, op_push, op_pop, op_dup, op_flip, op_keyset, op_keyhas, op_keyget, op_keydel, op_stacklen, op_memorylen, op_arealen, op_read, op_write, op_area, op_dearea, op_alloc, op_dealloc, op_add, op_sub, op_not, op_mul, op_div, op_mod, op_sha256, op_ecverify, op_memcpy, op_memset, op_memcmp, op_memhash]
+
+def decodeat(code, ip):
+    """Returns (handler, operand, reqs) for the instruction at ip, None if it has no REQS entry"""
+    instr = code[ip]
+    try:
+        reqs = REQS[instr]
+    except (IndexError, TypeError):
+        return None
+    if ip + reqs[1] - 1 >= len(code):
+        return (op_outofcode, None, reqs)
+    if 0 <= instr < len(HANDLERS):
+        handler = HANDLERS[instr]
+    else:
+        handler = op_unknown
+    return (handler, code[ip+1] if reqs[1] > 1 else None, reqs)
+
+def decode(code):
+    """Pre-decodes code for every instruction pointer, jumps may land anywhere"""
+    return [decodeat(code, ip) for ip in range(len(code))]
+
+# Instructions that can neither fail nor change anything but the stack, with
+# the stack depth they need to behave normally and their effect on it
+PURE = {
+    op_push: (0, 1),
+    op_pop: (1, -1),
+    op_dup: (1, 1),
+    op_flip: (2, 0),
+    op_keyhas: (1, 0),
+    op_add: (2, -1),
+    op_sub: (2, -1),
+    op_not: (1, 0),
+    op_mul: (2, -1),
+}
+
+def blocks(decoded):
+    """Basic block analysis. For every instruction pointer, returns the run of
+    PURE instructions starting there as (number of instructions, required
+    stack depth, gas, gas charged before the last instruction, weight, offset).
+    Executing it charges every process weight * flatlen + offset memory."""
+    result = [None] * len(decoded)
+    empty = (0, 0, 0, 0, 0, 0)
+    for ip in range(len(decoded)-1, -1, -1):
+        op = decoded[ip]
+        if op is None or op[0] not in PURE:
+            continue
+        handler, arg, reqs = op
+        need, effect = PURE[handler]
+        cost = reqs[4]
+        nxt = ip + reqs[1]
+        rest = result[nxt] if nxt < len(decoded) and result[nxt] is not None else empty
+        count, restneed, gas, last, weight, offset = rest
+        result[ip] = (
+            count + 1,
+            max(need, restneed - effect),
+            gas + cost,
+            cost + last if count else 0,
+            weight + cost,
+            offset + effect * weight,
+        )
+    return result
+
+def runblock(states, process, block):
+    """Charges and executes a basic block at once. Returns False without
+    changing anything if a process could run out of gas or memory within"""
+    count, need, gas, last, weight, offset = block
+    use = flatlen(process) * weight + offset
+    for p in states:
+        p = p[0]
+        if p[MEM] < use or 0 <= p[GAS] <= last:
+            return False
+    for p in states:
+        p = p[0]
+        p[GAS] -= gas
+        p[MEM] -= use
+    state = process[0]
+    decoded = process[3]
+    for i in range(count):
+        handler, arg, reqs = decoded[state[IP]]
+        handler(process, state, arg)
+    return True
+
+def replay(states, level, area, cache):
+    """Finishes the RUN of the child in a memory area, which was just given
+    its gas and mem, with its final state from a run cache (see
+    runcache.py). Charges every process in the chain the gas and mem the run
+    did, if none of them could have run out in between. Otherwise measures
+    the run (see record). Returns whether it replayed"""
+    process = states[level]
+    state = process[0]
+    child = state[MEMORY][area]
+    if isinstance(child, Child):
+        # Its own measurement started with the budget it had before
+        child.process[6] = None
+    key = cache.key(child)
+    found = cache.get(key)
+    if found is not None and found[2] is not None:
+        final, gas, mem = found
+        for p in states[:level+1]:
+            p = p[0]
+            if 0 <= p[GAS] <= gas or p[MEM] < mem:
+                break
+        else:
+            flush(states, level)
+            process[2] += len(final) - len(state[MEMORY][area])
+            ownmemory(process)[area] = adopt(process, list(final))
+            for p in states:
+                p[0][GAS] -= gas
+                p[0][MEM] -= mem
+            del state[STACK][-3:]
+            state[MEM] += 3
+            state[IP] += 1
+            return True
+    process[6] = (key, state[GAS], state[MEM], child[GAS])
+    return False
+
+def record(process, area, cache):
+    """Remembers the child run a process measured since replay, when RUN
+    finishes it. The child is charged like its parent, so their gas has to
+    agree, or a host changed the budgets while it ran"""
+    key, gas, mem, childgas = process[6]
+    process[6] = None
+    state = process[0]
+    final = state[MEMORY][area]
+    if cache is not None and gas - state[GAS] == childgas - final[GAS]:
+        cache.put(key, final, gas - state[GAS], mem - state[MEM])
+
+def dispatch(states, steps=None, cache=None):
+    """Advances a resident process chain like execute(), running pre-decoded
+    code through HANDLERS instead of the reference interpreter. With a run
+    cache (see runcache.py), RUN replays child runs it has seen before in a
+    single step"""
+    top = states[0][0]
+    count = 0
+    while (top[STATUS] == NORMAL or top[STATUS] == RECURSE) and count != steps:
+        count += 1
+        level = 0
+        while True:
+            process = states[level]
+            state = process[0]
 
-import numpy as np
-import matplotlib.pyplot as plt
+            if state[GAS] == 0:
+                state[STATUS] = OOG
+                break
 
-fig, ax1 = plt.subplots()
-ax1.set_xlabel('step (c)')
-axes = [ax1]
-for i in range(numlines-2):
-    axes.append(axes[-1].twinx())
+            code = state[CODE]
+            ip = state[IP]
+            if ip >= len(code):
+                state[STATUS] = OOC
+                break
 
-labels = ["memsec", "gas", "statesize (words)"]
-colors = ["tab:red", "tab:blue", "tab:grey"]
+            if ip >= 0:
+                if process[3] is None:
+                    process[3] = decode(code)
+                    process[4] = blocks(process[3])
+                op = process[3][ip]
+            else:
+                op = decodeat(code, ip)
+            if op is None:
+                # Fails like advance() does for opcodes without REQS entry
+                REQS[code[ip]]
+
+            handler, arg, reqs = op
+            if handler is op_outofcode:
+                state[STATUS] = OOC
+                break
 
-for i,ax in enumerate(axes):
-    ax.plot([], [], color=colors[i])
-    ax.set_ylabel(labels[i], color=colors[i])
+            stack = state[STACK]
+            if len(stack) < reqs[2]:
+                state[STATUS] = OOS
+                break
 
-plt.pause(0.0001)
+            if handler is op_run:
+                area, gas, mem = stack[-3:]
+                if len(states) > level + 1 and states[level+1][1] != area:
+                    flush(states, level)
+                memory = state[MEMORY]
+                if area >= len(memory):
+                    state[STATUS] = OOB
+                elif len(memory[area]) > 4:#HEADERLEN
+                    child = childstate(process, area)
+
+                    if state[REC] == 0:
+                        child[STATUS] = NORMAL
+                        child[GAS] = gas
+                        child[MEM] = mem
+                        if cache is not None and replay(states, level, area, cache):
+                            break
+                        state[REC] = area + 1
+
+                    if state[REC] > 0 and child[STATUS] == NORMAL:
+                        if len(states) == level + 1:
+                            enter(states, area)
+                        level += 1
+                        continue
+
+                    flush(states, level)
+                    # A finished RUN is free, but fails if a process is out of memory
+                    for p in states:
+                        if p[0][MEM] < 0:
+                            p[0][STATUS] = OOM
+                            break
+                    else:
+                        state[REC] = 0
+                        if process[6] is not None:
+                            record(process, area, cache)
+                        del stack[-3:]
+                        state[MEM] += 3
+                        state[IP] += 1
+                        continue
+                    break
+                del stack[-3:]
+                state[MEM] += 3
+                state[IP] += 1
+                continue
+
+            if len(states) > level + 1:
+                flush(states, level)
+
+            # Straight-line code is charged and executed a block at a time,
+            # unless an invalid RUN just stopped this process within the step
+            block = process[4][ip] if ip >= 0 else None
+            if block is not None and block[0] > 1 and len(stack) >= block[1] \
+                    and (state[STATUS] == NORMAL or state is top and state[STATUS] == RECURSE) \
+                    and (steps is None or count + block[0] - 1 <= steps) \
+                    and runblock(states, process, block):
+                count += block[0] - 1
+                break
 
-def run(state, gas=100, mem=100, debug=False):
+            charge = reqs[4]
+            if reqs[5]:
+                charge = cost(reqs, stack)
+            use = flatlen(process) * charge
+            for p in states:
+                p = p[0]
+                if reqs[5] and 0 <= p[GAS] < charge:
+                    p[STATUS] = OOG
+                    break
+                p[GAS] -= charge
+                if p[MEM] < use:
+                    p[STATUS] = OOM
+                    break
+                p[MEM] -= use
+            else:
+                handler(process, state, arg)
+            break
+    if cache is not None and top[STATUS] != NORMAL and top[STATUS] != RECURSE:
+        # The host may change the budgets before it resumes
+        for process in states:
+            process[6] = None
+    return count
+
+def execute(states, steps=None, cache=None):
+    """Advances a resident process chain until its top level process stops
+    or `steps` steps have been executed. Returns the number of steps. The
+    reference interpreter runs every RUN, cache is ignored"""
+    count = 0
+    while states[0][0][STATUS] in [NORMAL, RECURSE] and count != steps:
+        advance(states)
+        count += 1
+    return count
+
+def run(state, gas=100, mem=100, debug=False, checkpoint=None, interval=1000, tracer=None, sample=1, engine=dispatch, limit=None, cache=None):
+    """Runs a flat state until it stops. The state is kept resident in between,
+    checkpoint is called with a flat copy every interval steps if given.
+    tracer (see tracing.py) is called every sample steps and when the run stops.
+    engine is dispatch or execute, the reference interpreter. limit stops the
+    run after that many steps, even if the process could go on. With a run
+    cache (see runcache.py), a run without debug, checkpoint, tracer and limit
+    that was cached returns its final state right away.
+    Returns the final flat state, as Words if state was Words"""
     state[STATUS] = NORMAL
     state[GAS] = gas
     state[MEM] = mem
 
-    #for i,ax in enumerate(axes):
-    #    ax.set_ylim([0,0,0][i], [gas*mem,gas,mem][i])
-
+    key = None
+    if cache is not None and not debug and checkpoint is None and tracer is None and limit is None:
+        key = cache.key(state)
+        found = cache.get(key)
+        if found is not None:
+            if isinstance(state, Words):
+                return Words(found[0])
+            return list(found[0])
+
+    states = load(state)
+    resume(states, debug, checkpoint, interval, tracer, sample, engine, limit, cache)
+    final = s(states[0][0])
+    if key is not None:
+        cache.put(key, final, gas - final[GAS])
+    if isinstance(state, Words):
+        return Words(final)
+    return final
+
+def resume(states, debug=False, checkpoint=None, interval=1000, tracer=None, sample=1, engine=dispatch, limit=None, cache=None):
+    """Runs a resident process chain until it stops (or limit steps) and
+    flushes it, see run. Returns the number of steps"""
     count = 0
     while True:
-        #sleep(0.1)
-        #show(state)
         #import timeit
-        #print(state)
-        #t = timeit.timeit("step([0, 0, 1000, 1000, 0, 98, 0, 0, 3, 6, 1, 15, 8, 6, 1, 9, 6, 1, 6, 2, 20, 6, 1, 6, 8, 6, 1, 6, 8, 16, 6, 1, 22, 17, 6, 1, 17, 8, 6, 1, 22, 6, 1, 9, 14, 6, 1, 23, 6, 0, 16, 17, 7, 6, 1, 6, 50, 6, 50, 3, 6, 1, 6, 1, 15, 6, 1, 23, 16, 6, 1, 6, 2, 21, 6, 1, 6, 8, 6, 1, 6, 8, 16, 6, 1, 23, 17, 14, 6, 1, 23, 8, 8, 19, 18, 6, 1, 20, 9, 6, 0, 9, 17, 2, 6, 0, 4, 0, 37, 1, 0, 0, 0, 0, 27, 0, 0, 1, 14, 6, 1, 23, 6, 0, 16, 6, 1, 22, 14, 6, 1, 23, 8, 8, 19, 18, 6, 1, 20, 9, 6, 0, 9, 17, 1, 0, 1, 1])", "from vm import step", number=100000)
+        #t = timeit.timeit("step([0, 0, 1000, 1000, 0, 98, 0, 0, 3, 6, 1, 15, 8, 6, 1, 9, 6, 1, 6, 2, 20, 6, 1, 6, 8, 6, 1, 6, 8, 16, 6, 1, 22, 17, 6, 1, 17, 8, 6, 1, 22, 6, 1, 9, 14, 6, 1, 23, 6, 0, 16, 17, 7, 6, 1, 6, 50, 6, 50, 3, 6, 1, 6, 1, 15, 6, 1, 23, 16, 6, 1, 6, 2, 21, 6, 1, 6, 8, 6, 1, 6, 8, 16, 6, 1, 23, 17, 14, 6, 1, 23, 8, 8, 19, 18, 6, 1, 20, 9, 6, 0, 9, 17, 1, 0, 1, 1])", "from vm import step", number=100000)
         #print(t)
-        #print(d(state)[MEMORY])
-        stats[0].append(count)
-        stats[1].append(state[MEM])
-        stats[2].append(state[GAS])
-        stats[3].append(len(state))
-        for i in range(1,4):
-            ax = axes[i-1]
-            ax.lines[0].set_xdata(stats[0])#stats[2]
-            ax.lines[0].set_ydata(stats[i])
-
-            ax.relim()
-            ax.autoscale_view()
-        #plt.pause(0.0000001)
-        fig.canvas.draw()
-        if state[STATUS] not in [NORMAL, RECURSE]:
+        top = states[0][0]
+        if top[STATUS] not in [NORMAL, RECURSE] or count == limit:
+            if tracer is not None:
+                tracer.trace(count, states)
+            flush(states)
             if debug:
-                dstate = d(state)
-                print(STATI[dstate[STATUS]], dstate[GAS], dstate[MEM])
-                print(dstate)
+                print(STATI[top[STATUS]], top[GAS], top[MEM])
+                print(top)
             break
-        state = step(state)
-        if debug:
-            out = d(state)
-            #print(out[STACK], out[MEMORY])
-            #sleep(0.1)
-        count += 1
-    return state
+
+        # Run up to the next sample or checkpoint
+        steps = None
+        if tracer is not None:
+            if count % sample == 0:
+                tracer.trace(count, states)
+            steps = sample - count % sample
+        if checkpoint is not None:
+            until = interval - count % interval
+            steps = until if steps is None else min(steps, until)
+        if limit is not None:
+            steps = limit - count if steps is None else min(steps, limit - count)
+        count += engine(states, steps, cache)
+        if checkpoint is not None and count % interval == 0:
+            checkpoint(dump(states))
+    return count
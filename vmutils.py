@@ -5,9 +5,14 @@ import zlib
 import base64
 import struct
 
+from words import Words
+
 def minify(state):
-    byte = conv(state)
-    bytearr = bytearray(byte)
+    if isinstance(state, Words):
+        bytearr = state.tobytes(4)
+    else:
+        byte = conv(state)
+        bytearr = bytearray(byte)
     #bytearr = struct.pack(">I" % (len(byte)), byte)
     compressed = zlib.compress(bytearr)
     #print("Uncompressed:", len(bytearr), "Compressed:", len(compressed))
@@ -0,0 +1,133 @@
+"""Compact container for flat states.
+
+Words keeps a flat state in an array of unsigned 64 bit machine words instead
+of a list of Python ints. Values that do not fit (full 256 bit words, negative
+GAS or MEM, the None DUP pushes on an empty stack) are escaped into a dict.
+Indexing returns values and slices return lists, so d() and step() read it
+like a list."""
+
+import sys
+import hashlib
+from array import array
+
+ESCAPE = 2**64 - 1
+
+def typecode(size, signed):
+    """Array typecode for words of `size` bytes"""
+    for code in ("bhilq" if signed else "BHILQ"):
+        if array(code).itemsize == size:
+            return code
+    raise ValueError("no %i byte array type" % size)
+
+class Words:
+    """Flat state backed by array('Q'), with a dict for values that do not fit"""
+
+    def __init__(self, values=()):
+        self.words = array("Q")
+        self.big = {}
+        self.extend(values)
+
+    @classmethod
+    def frombytes(cls, data, size=8, signed=False):
+        """Reads big-endian words, see tobytes"""
+        packed = array(typecode(size, signed))
+        packed.frombytes(data)
+        if sys.byteorder == "little":
+            packed.byteswap()
+        return cls(packed)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if not self.big:
+                return self.words[index].tolist()
+            return [self[i] for i in range(*index.indices(len(self.words)))]
+        word = self.words[index]
+        if word == ESCAPE:
+            return self.big[index % len(self.words)]
+        return word
+
+    def __setitem__(self, index, value):
+        index = range(len(self.words))[index]
+        if type(value) is int and 0 <= value < ESCAPE:
+            self.words[index] = value
+            self.big.pop(index, None)
+        else:
+            self.words[index] = ESCAPE
+            self.big[index] = value
+
+    def __iter__(self):
+        if not self.big:
+            return iter(self.words)
+        return (self.big[i] if word == ESCAPE else word for i, word in enumerate(self.words))
+
+    def __eq__(self, other):
+        if isinstance(other, Words):
+            return self.words == other.words and self.big == other.big
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Words(%r)" % self.tolist()
+
+    def append(self, value):
+        self.words.append(0)
+        self[-1] = value
+
+    def extend(self, values):
+        if isinstance(values, Words):
+            offset = len(self.words)
+            self.words.extend(values.words)
+            for index, value in values.big.items():
+                self.big[offset + index] = value
+            return
+        if isinstance(values, array):
+            if values.typecode != "Q":
+                values = values.tolist()
+        elif not isinstance(values, (list, tuple)):
+            values = list(values)
+        start = len(self.words)
+        try:
+            self.words.extend(values)
+            if ESCAPE not in self.words[start:]:
+                return
+        except (OverflowError, TypeError):
+            pass
+        del self.words[start:]
+        for value in values:
+            self.append(value)
+
+    def copy(self):
+        copied = Words()
+        copied.words = array("Q", self.words)
+        copied.big = dict(self.big)
+        return copied
+
+    def tolist(self):
+        return list(self)
+
+    def tobytes(self, size=8, signed=False):
+        """Big-endian bytes of all words, raises OverflowError if one does not fit"""
+        code = typecode(size, signed)
+        if code == "Q" and not self.big:
+            packed = array(code, self.words)
+        else:
+            packed = array(code, self.tolist())
+        if sys.byteorder == "little":
+            packed.byteswap()
+        return packed.tobytes()
+
+    def digest(self):
+        """SHA256 of the contents, equal for equal Words"""
+        packed = array("Q", self.words)
+        if sys.byteorder == "little":
+            packed.byteswap()
+        h = hashlib.sha256(packed.tobytes())
+        for index in sorted(self.big):
+            h.update(repr((index, self.big[index])).encode())
+        return h.digest()